@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import aiohttp
+
+import iconik
+import metrics
+import ratelimit
+
+logger = logging.getLogger()
+
+class Client:
+    """
+    asyncio iconik client for running many API calls at once from one
+    thread.  At most `concurrency` requests are in flight, and a 429 from
+    iconik pauses every request on this client for the Retry-After time
+    instead of letting each one hammer the API on its own.
+
+        async with aioiconik.Client(url,headers) as client:
+            await client.put_metadata(asset_id,view_id,payload)
+    """
+    def __init__(self, url, headers, concurrency=50):
+        self.url = url
+        self.headers = dict(headers,**{'Content-Type':'application/json'})
+        self.concurrency = concurrency
+        self.session = None
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.paused_until = 0
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=iconik.timeout[0],sock_read=iconik.timeout[1])
+        self.session = aiohttp.ClientSession(connector=connector,timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def wait_for_pause(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until,time.monotonic() + seconds)
+
+    async def request(self, method, path, data=None):
+        """
+        Makes one API call and returns the decoded JSON body ({} if empty).
+        Retries like iconik.get_session(): connection errors and 429/5xx,
+        but POSTs only on 429.  Raises IconikException on failure.
+        """
+        body = json.dumps(data) if data is not None else None
+        bucket = ratelimit.get_bucket(method,'/' + path)
+        #the limiter locks a shared sqlite database, which mustn't block the event loop
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await self.wait_for_pause()
+            wait = await loop.run_in_executor(None,ratelimit.reserve,bucket)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = await loop.run_in_executor(None,ratelimit.reserve,bucket)
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method,self.url + path,headers=self.headers,data=body) as r:
+                        status = r.status
+                        retry_after = r.headers.get('Retry-After')
+                        text = await r.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= iconik.retries:
+                    raise iconik.IconikException(method + ' ' + path + ' failed: ' + str(e))
+                logger.debug(method + ' ' + path + ' failed, retrying: ' + str(e))
+            else:
+                if status < 400:
+                    try:
+                        return json.loads(text) if text else {}
+                    except ValueError:
+                        return {}
+                retryable = status == 429 or (status in iconik.retry_statuses and method != 'POST')
+                if not retryable or attempt >= iconik.retries:
+                    raise iconik.IconikException(method + ' ' + path + ' failed with status ' + str(status) + ': ' + text)
+                if status == 429:
+                    try:
+                        wait = float(retry_after)
+                    except (TypeError, ValueError):
+                        wait = iconik.backoff * (2 ** attempt)
+                    logger.info('iconik rate limit hit, pausing for ' + str(wait) + ' seconds')
+                    self.pause(wait)
+                    await loop.run_in_executor(None,ratelimit.throttle,bucket,wait)
+                    attempt += 1
+                    continue
+            await asyncio.sleep(iconik.backoff * (2 ** attempt) * random.uniform(0.5,1.0))
+            attempt += 1
+
+    async def create_asset(self, data):
+        return await self.request('POST','API/assets/v1/assets/',data)
+
+    async def update_asset(self, asset_id, data):
+        return await self.request('PATCH','API/assets/v1/assets/' + asset_id + '/',data)
+
+    async def delete_asset(self, asset_id):
+        return await self.request('DELETE','API/assets/v1/assets/' + asset_id + '/')
+
+    async def create_proxy(self, asset_id, data):
+        return await self.request('POST','API/files/v1/assets/' + asset_id + '/proxies/',data)
+
+    async def update_proxy(self, asset_id, proxy_id, data):
+        return await self.request('PATCH','API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id + '/',data)
+
+    async def get_proxies(self, asset_id):
+        return await self.request('GET','API/files/v1/assets/' + asset_id + '/proxies/')
+
+    async def delete_proxy(self, asset_id, proxy_id):
+        return await self.request('DELETE','API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id)
+
+    async def create_keyframes(self, asset_id, proxy_id):
+        return await self.request('POST','API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id + '/keyframes/')
+
+    async def put_metadata(self, asset_id, view_id, payload):
+        return await self.request('PUT','API/metadata/v1/assets/' + asset_id + '/assets/' + asset_id + '/views/' + view_id + '/',payload)
+
+async def delete_worker(client, asset_ids, results):
+    for asset_id in asset_ids:
+        try:
+            with metrics.span('delete',asset_id=asset_id):
+                await client.delete_asset(asset_id)
+            logger.info('Deleted iconik asset ' + asset_id)
+            results.append((asset_id,None))
+        except iconik.IconikException as e:
+            logger.error('Could not delete iconik asset ' + asset_id + ': ' + str(e))
+            results.append((asset_id,str(e)))
+
+async def delete_all(url, headers, asset_ids, concurrency):
+    results = []
+    asset_ids = iter(asset_ids)
+    async with Client(url,headers,concurrency) as client:
+        await asyncio.gather(*[delete_worker(client,asset_ids,results) for i in range(concurrency)])
+    return results
+
+def delete_assets(url, headers, asset_ids, concurrency=20):
+    """
+    Deletes many assets at once from a single event loop and returns a
+    list of (asset ID, error) with error None on success
+    """
+    return asyncio.run(delete_all(url,headers,asset_ids,concurrency))
+
+async def proxy_worker(client, asset_ids, results):
+    for asset_id in asset_ids:
+        try:
+            response = await client.get_proxies(asset_id)
+            proxies = [proxy for proxy in response.get('objects',[]) if proxy.get('status') == 'CLOSED']
+            results.append((asset_id,len(proxies),None))
+        except iconik.IconikException as e:
+            logger.error('Could not list proxies of iconik asset ' + asset_id + ': ' + str(e))
+            results.append((asset_id,None,str(e)))
+
+async def count_all(url, headers, asset_ids, concurrency):
+    results = []
+    asset_ids = iter(asset_ids)
+    async with Client(url,headers,concurrency) as client:
+        await asyncio.gather(*[proxy_worker(client,asset_ids,results) for i in range(concurrency)])
+    return results
+
+def count_proxies(url, headers, asset_ids, concurrency=20):
+    """
+    Counts the finished (CLOSED) proxies of many assets at once and
+    returns a list of (asset ID, count, error), count is None on error
+    """
+    return asyncio.run(count_all(url,headers,asset_ids,concurrency))
@@ -0,0 +1,189 @@
+import time
+import requests
+
+import iconik
+import store
+
+#CatDV clip to iconik asset to proxy, so we can find and repair drift without asking CatDV
+schema = '''
+CREATE TABLE IF NOT EXISTS assets (
+    asset_id TEXT PRIMARY KEY,
+    catdv_id TEXT,
+    proxy_id TEXT,
+    path TEXT,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_catdv_id ON assets (catdv_id);
+CREATE INDEX IF NOT EXISTS assets_status ON assets (status);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (fingerprint, asset_id)
+);
+'''
+
+#uploading: asset and proxy exist but the upload hasn't been finalized
+#ok: finished, or known to exist because a CatDV clip points at it
+#deleted: gone from iconik, kept so we remember which clip it belonged to
+statuses = ('uploading','ok','deleted')
+
+def to_entry(row):
+    return dict(zip(('asset_id','catdv_id','proxy_id','path','status','created','updated'),row))
+
+def record(asset_id, status, proxy_id=None, path=None, catdv_id=None):
+    """
+    Adds or updates the entry for asset_id, keeping what we already know
+    about it for anything passed as None
+    """
+    now = time.time()
+    with store.open_db('index',schema) as db:
+        db.execute('''INSERT INTO assets (asset_id, catdv_id, proxy_id, path, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (asset_id) DO UPDATE SET catdv_id = coalesce(excluded.catdv_id, catdv_id), proxy_id = coalesce(excluded.proxy_id, proxy_id),
+            path = coalesce(excluded.path, path), status = excluded.status, updated = excluded.updated''',(asset_id,catdv_id,proxy_id,path,status,now,now))
+
+def link_many(pairs):
+    """
+    Records that each (asset ID, CatDV ID) pair belongs together, for
+    assets made before the index existed or without a CatDV ID
+    """
+    now = time.time()
+    rows = [(asset_id,catdv_id,now,now) for asset_id,catdv_id in pairs if asset_id and catdv_id]
+    if not rows:
+        return
+    with store.open_db('index',schema) as db:
+        db.executemany('''INSERT INTO assets (asset_id, catdv_id, status, created, updated) VALUES (?, ?, 'ok', ?, ?)
+            ON CONFLICT (asset_id) DO UPDATE SET catdv_id = excluded.catdv_id, updated = excluded.updated''',rows)
+
+def link(asset_id, catdv_id):
+    link_many([(asset_id,catdv_id)])
+
+def forget_many(asset_ids):
+    now = time.time()
+    with store.open_db('index',schema) as db:
+        db.executemany("UPDATE assets SET status = 'deleted', updated = ? WHERE asset_id = ?",[(now,asset_id) for asset_id in asset_ids])
+
+def forget(asset_id):
+    forget_many([asset_id])
+
+def get_entry(asset_id):
+    with store.open_db('index',schema) as db:
+        row = db.execute('SELECT * FROM assets WHERE asset_id = ?',(asset_id,)).fetchone()
+    return to_entry(row) if row is not None else None
+
+def find(catdv_id):
+    """
+    Returns the live entries for a CatDV clip, newest first.  More than
+    one means the clip has duplicate assets in iconik.
+    """
+    with store.open_db('index',schema) as db:
+        rows = db.execute("SELECT * FROM assets WHERE catdv_id = ? AND status != 'deleted' ORDER BY created DESC",(catdv_id,)).fetchall()
+    return [to_entry(row) for row in rows]
+
+#fingerprints of proxies we finished uploading, so the same content isn't uploaded twice
+def remember_fingerprint(fingerprint, asset_id):
+    with store.open_db('index',schema) as db:
+        db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',(fingerprint,asset_id,time.time()))
+
+def find_fingerprint(fingerprint, catdv_id=None):
+    """
+    Returns the live entry of an asset a proxy with this fingerprint was
+    uploaded to, or None.  The same content can belong to several CatDV
+    clips, so only an asset of catdv_id or one no clip has claimed is
+    returned, never another clip's, even when catdv_id is None.
+    """
+    with store.open_db('index',schema) as db:
+        rows = db.execute("SELECT assets.* FROM fingerprints JOIN assets USING (asset_id) WHERE fingerprint = ? AND status = 'ok' ORDER BY fingerprints.created DESC",(fingerprint,)).fetchall()
+    entries = [to_entry(row) for row in rows]
+    for wanted in (catdv_id,None):
+        for entry in entries:
+            if entry['catdv_id'] == wanted:
+                return entry
+    return None
+
+def get_fingerprints(asset_id):
+    with store.open_db('index',schema) as db:
+        return [row[0] for row in db.execute('SELECT fingerprint FROM fingerprints WHERE asset_id = ?',(asset_id,)).fetchall()]
+
+def live_entries():
+    with store.open_db('index',schema) as db:
+        rows = db.execute("SELECT * FROM assets WHERE status != 'deleted' ORDER BY created").fetchall()
+    return [to_entry(row) for row in rows]
+
+def iter_iconik_assets(url, headers, per_page=500):
+    """
+    Pages through every asset in iconik, per_page at a time, and yields
+    each asset object.  Raises IconikException if a page can't be read.
+    """
+    page = 1
+    while True:
+        try:
+            r = iconik.list_assets(url,headers,page,per_page)
+            response = r.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise iconik.IconikException('Could not list iconik assets: ' + str(e))
+        if r.status_code >= 400:
+            raise iconik.IconikException('Could not list iconik assets, iconik returned status ' + str(r.status_code) + ': ' + r.text)
+        objects = response.get('objects') or []
+        for asset in objects:
+            yield asset
+        if not objects or page >= response.get('pages',page):
+            return
+        page += 1
+
+def find_drift(entries, iconik_ids, cutoff):
+    """
+    Compares live index entries with the asset IDs iconik has and returns
+    a dict of lists of entries:
+
+        gone        in the index but no longer in iconik
+        duplicates  extra assets for a CatDV clip, each with a 'keep' key
+                    naming the asset we keep (finished first, then newest)
+        orphans     finished assets no CatDV clip has claimed, which
+                    includes uploads made without a CatDV ID that CatDV
+                    may still point at
+        missing     assets whose proxy never finished uploading
+
+    Only entries last touched before cutoff count as orphans or missing
+    proxies, so uploads and Worker round trips in progress are left alone.
+    """
+    drift = {'gone':[],'duplicates':[],'orphans':[],'missing':[]}
+    clips = {}
+    for entry in entries:
+        if entry['asset_id'] not in iconik_ids:
+            if entry['created'] < cutoff:
+                drift['gone'].append(entry)
+            continue
+        if entry['catdv_id'] is not None:
+            clips.setdefault(entry['catdv_id'],[]).append(entry)
+        elif entry['status'] == 'ok' and entry['updated'] < cutoff:
+            drift['orphans'].append(entry)
+    for catdv_id, clip_entries in clips.items():
+        clip_entries.sort(key=lambda entry: (entry['status'] == 'ok',entry['created']),reverse=True)
+        keep = clip_entries[0]
+        for entry in clip_entries[1:]:
+            drift['duplicates'].append(dict(entry,keep=keep['asset_id']))
+        if keep['status'] == 'uploading' and keep['updated'] < cutoff:
+            drift['missing'].append(keep)
+    drift['missing'].extend([entry for entry in entries if entry['catdv_id'] is None and entry['status'] == 'uploading' and entry['updated'] < cutoff and entry['asset_id'] in iconik_ids])
+    return drift
+
+class Linker(object):
+    """
+    Collects (asset ID, CatDV ID) pairs from a batch and writes them in
+    chunks, so a big export doesn't cost a transaction per clip
+    """
+    def __init__(self, size=500):
+        self.size = size
+        self.pairs = []
+
+    def add(self, asset_id, catdv_id):
+        self.pairs.append((asset_id,catdv_id))
+        if len(self.pairs) >= self.size:
+            self.flush()
+
+    def flush(self):
+        pairs, self.pairs = self.pairs, []
+        link_many(pairs)
@@ -0,0 +1,203 @@
+import logging
+import time
+
+import store
+
+logger = logging.getLogger()
+
+#upload caps in bytes per second, overridden by the [bandwidth] section of config.ini, None is no cap
+rate = None
+bulk_rate = None
+#(start minute, end minute, bytes per second) times of day with their own bulk cap, 0 holds bulk uploads
+windows = []
+#fraction of its cap bulk uploads keep while an interactive upload is running
+bulk_share = 0.1
+#seconds after its last chunk that an interactive upload still counts as running
+interactive_idle = 5.0
+#seconds worth of bytes a bucket can save up
+burst = 1.0
+#bytes taken from the buckets at a time
+slice_size = 256 * 1024
+#seconds to wait before looking again while bulk uploads are held
+hold_poll = 30.0
+
+priorities = ('interactive','bulk')
+#class of this process's uploads, scripts set it from their mode
+process_priority = 'interactive'
+
+#state is shared through sqlite so every process and upload thread draws on the same caps, it's fine to lose it in a crash
+schema = '''
+PRAGMA synchronous=OFF;
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS activity (
+    priority TEXT PRIMARY KEY,
+    active_until REAL NOT NULL
+);
+'''
+
+class BandwidthException(Exception):
+    pass
+
+def parse_mbps(value):
+    value = float(value)
+    return value * 125000 if value > 0 else None
+
+def parse_minute(value):
+    hours, minutes = value.strip().split(':')
+    if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60):
+        raise ValueError(value)
+    return int(hours) * 60 + int(minutes)
+
+def parse_windows(value):
+    """
+    Parses "08:00-18:00=20, 18:00-08:00=200" into a list of (start minute,
+    end minute, bytes per second).  A window may run past midnight.
+    """
+    result = []
+    for window in value.split(','):
+        if not window.strip():
+            continue
+        try:
+            span, mbps = window.split('=')
+            start, end = span.split('-')
+            result.append((parse_minute(start),parse_minute(end),max(0.0,float(mbps)) * 125000))
+        except ValueError:
+            logger.error('Ignoring bandwidth window ' + window.strip() + ', use HH:MM-HH:MM=Mbit/s')
+    return result
+
+def configure(config):
+    """
+    Reads the optional [bandwidth] section of config.ini
+    """
+    global rate, bulk_rate, windows, bulk_share, burst
+    rate = parse_mbps(config.get('bandwidth','rate-mbps',fallback=0))
+    bulk_rate = parse_mbps(config.get('bandwidth','bulk-rate-mbps',fallback=0))
+    windows = parse_windows(config.get('bandwidth','bulk-windows',fallback=''))
+    bulk_share = config.getfloat('bandwidth','bulk-share',fallback=bulk_share)
+    burst = config.getfloat('bandwidth','burst-seconds',fallback=burst)
+
+def set_priority(value):
+    global process_priority
+    if value not in priorities:
+        raise BandwidthException('Unknown upload priority ' + str(value))
+    process_priority = value
+
+def is_enabled():
+    return rate is not None or bulk_rate is not None or len(windows) > 0
+
+def get_bulk_cap(now):
+    """
+    Returns the bulk cap in bytes per second for the time of day, None
+    for no cap of its own and 0 while bulk uploads are held
+    """
+    local = time.localtime(now)
+    minute = local.tm_hour * 60 + local.tm_min
+    for start, end, cap in windows:
+        if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+            return cap
+    return bulk_rate
+
+def refill(db, name, cap, size, now):
+    #a bucket always holds at least one request's worth so a slice bigger than the burst can still go
+    limit = max(cap * burst,size)
+    row = db.execute('SELECT tokens, updated FROM buckets WHERE name = ?',(name,)).fetchone()
+    if row is None:
+        return limit
+    tokens, updated = row
+    return min(limit,tokens + max(0.0,now - updated) * cap)
+
+def reserve(size, priority, hold=True):
+    """
+    Takes size bytes from the global bucket, and for bulk uploads from
+    the bulk bucket, and returns (seconds to wait, taken).  Interactive
+    uploads may put the global bucket into debt and wait it off.  Bulk
+    uploads take nothing until their own bucket has the bytes, so while
+    they wait the global bucket stays free for interactive uploads.
+    With hold False a bulk window of 0 doesn't hold, so a request that is
+    already open can finish.
+    """
+    now = time.time()
+    with store.open_db('bandwidth',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        if priority == 'interactive':
+            db.execute('INSERT OR REPLACE INTO activity VALUES (?, ?)',('interactive',now + interactive_idle))
+        else:
+            cap = get_bulk_cap(now)
+            if cap == 0:
+                if hold:
+                    return hold_poll, False
+                cap = None
+            #an interactive upload running anywhere squeezes bulk down to its share
+            row = db.execute('SELECT active_until FROM activity WHERE priority = ?',('interactive',)).fetchone()
+            if row is not None and row[0] > now:
+                limits = [value for value in (cap,rate) if value is not None]
+                cap = min(limits) * bulk_share if limits else None
+            if cap is not None:
+                tokens = refill(db,'bulk',cap,size,now)
+                if tokens < size:
+                    db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',('bulk',tokens,now))
+                    return (size - tokens) / cap, False
+                db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',('bulk',tokens - size,now))
+        if rate is None:
+            return 0.0, True
+        tokens = refill(db,'all',rate,size,now) - size
+        db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',('all',tokens,now))
+    return max(0.0,-tokens / rate), True
+
+def acquire(size, priority=None, hold=True):
+    """
+    Blocks until size more bytes may be sent under the caps
+    """
+    priority = priority or process_priority
+    while True:
+        wait, taken = reserve(size,priority,hold)
+        if wait > 0:
+            time.sleep(wait)
+        if taken:
+            return
+
+class ShapedChunk(object):
+    """
+    A chunk of upload data that requests streams through read(), drawing
+    on the caps one slice at a time so every upload in every process
+    shares the bandwidth smoothly instead of in chunk sized bursts.
+    Holds and the wait for the first slice happen in prepare(), before
+    the request is sent, since storage drops a request that goes quiet.
+    """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+        self.allowance = 0
+
+    def prepare(self):
+        needed = min(slice_size,len(self))
+        if needed > self.allowance:
+            acquire(needed - self.allowance)
+            self.allowance = needed
+
+    def __len__(self):
+        return len(self.data) - self.position
+
+    def __iter__(self):
+        while True:
+            piece = self.read(slice_size)
+            if not piece:
+                return
+            yield piece
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self)
+        piece = self.data[self.position:self.position + size]
+        if len(piece) > self.allowance:
+            #the request is open by now, so only pace the bytes, never hold them
+            needed = max(slice_size,len(piece) - self.allowance)
+            acquire(needed,hold=False)
+            self.allowance += needed
+        self.allowance -= len(piece)
+        self.position += len(piece)
+        return piece.tobytes()
@@ -0,0 +1,255 @@
+"""
+Local stand-in for the parts of the iconik API these scripts call and for
+GCS resumable uploads, used by run.py.  Every response can be slowed down
+by a fixed latency plus jitter, request bodies share a bandwidth cap, and
+a fraction of calls can be failed with 503s or throttled with 429s.
+
+Run on its own with:
+
+    python bench/fakeiconik.py --port 8999 --latency 50 --bandwidth 100
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+content_range_pattern = re.compile(r'bytes (\*|(\d+)-(\d+))/(\d+)')
+
+class FakeIconik(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency=0.0, jitter=0.0, bandwidth=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1):
+        """
+        latency and jitter are in seconds, bandwidth in bytes per second
+        shared by every upload (0 for no cap), error_rate and throttle_rate
+        are the fraction of calls answered with a 503 or a 429
+        """
+        super().__init__(address,FakeHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.link_free = 0.0
+        #session id: [committed bytes, total bytes]
+        self.sessions = {}
+        #asset id: {proxy id: status}, in the order they were created
+        self.assets = {}
+        self.stats = {'requests':0,'bytes_in':0,'errors':0,'throttled':0,'assets':0,'proxies':0,'uploads':0,'metadata':0,'deletes':0}
+
+    @property
+    def base_url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1]) + '/'
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    #hold the request until the shared link would have carried its body
+    def pace(self, size):
+        if not self.bandwidth or not size:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now,self.link_free)
+            self.link_free = start + size / self.bandwidth
+            wait = self.link_free - now
+        time.sleep(wait)
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None and status != 204 else b''
+        self.send_response(status)
+        for key,value in (headers or {}).items():
+            self.send_header(key,value)
+        if data:
+            self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(size) if size else b''
+        self.server.count('requests')
+        self.server.count('bytes_in',len(body))
+        return body
+
+    #delay the response and maybe fail it, returns True if we already answered
+    def inject(self):
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter,server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < server.throttle_rate:
+            server.count('throttled')
+            self.reply(429,{'errors':['Too many requests']},{'Retry-After':str(server.retry_after)})
+            return True
+        if roll < server.throttle_rate + server.error_rate:
+            server.count('errors')
+            self.reply(503,{'errors':['Injected failure']})
+            return True
+        return False
+
+    def handle_call(self):
+        body = self.read_body()
+        path = self.path.split('?')[0]
+        method = self.command
+        if path == '/_stats':
+            with self.server.lock:
+                return self.reply(200,dict(self.server.stats))
+        if path.startswith('/gcs/'):
+            self.server.pace(len(body))
+        if path == '/API/auth/v1/auth/token/':
+            return self.reply(200,{'token':'bench'})
+        if not path.startswith('/gcs/start/') and self.inject():
+            return
+        if path.startswith('/gcs/'):
+            return self.handle_upload(method,path)
+        if method == 'DELETE':
+            self.server.count('deletes')
+            parts = path.strip('/').split('/')
+            with self.server.lock:
+                if path.startswith('/API/assets/'):
+                    self.server.assets.pop(parts[-1],None)
+                elif 'proxies' in parts:
+                    self.server.assets.get(parts[-3],{}).pop(parts[-1],None)
+            return self.reply(204)
+        if method == 'GET':
+            return self.handle_list(path)
+        if method == 'PUT' and path.startswith('/API/metadata/'):
+            self.server.count('metadata')
+            return self.reply(200,json.loads(body or b'{}'))
+        if method == 'PATCH':
+            parts = path.strip('/').split('/')
+            if 'proxies' in parts:
+                with self.server.lock:
+                    proxies = self.server.assets.get(parts[-3])
+                    if proxies is not None and parts[-1] in proxies:
+                        proxies[parts[-1]] = json.loads(body or b'{}').get('status',proxies[parts[-1]])
+            return self.reply(200,{})
+        if method == 'POST':
+            if path == '/API/assets/v1/assets/':
+                self.server.count('assets')
+                asset_id = str(uuid.uuid4())
+                with self.server.lock:
+                    self.server.assets[asset_id] = {}
+                return self.reply(201,{'id':asset_id})
+            if path.endswith('/proxies/'):
+                self.server.count('proxies')
+                proxy_id = str(uuid.uuid4())
+                with self.server.lock:
+                    self.server.assets.setdefault(path.strip('/').split('/')[-2],{})[proxy_id] = 'AWAITED'
+                return self.reply(201,{'id':proxy_id,'upload_url':self.server.base_url + 'gcs/start/' + str(uuid.uuid4())})
+            if path.endswith('/keyframes/'):
+                return self.reply(201,{})
+            if path.endswith(('/formats/','/file_sets/','/files/')):
+                return self.reply(201,{'id':str(uuid.uuid4())})
+        self.reply(404,{'errors':['Unknown call ' + method + ' ' + path]})
+
+    def handle_list(self, path):
+        server = self.server
+        if path == '/API/assets/v1/assets/':
+            query = dict(pair.split('=',1) for pair in self.path.partition('?')[2].split('&') if '=' in pair)
+            page = int(query.get('page',1))
+            per_page = int(query.get('per_page',10))
+            with server.lock:
+                asset_ids = list(server.assets)
+            objects = [{'id':asset_id,'type':'ASSET'} for asset_id in asset_ids[(page - 1) * per_page:page * per_page]]
+            return self.reply(200,{'objects':objects,'page':page,'per_page':per_page,'pages':(len(asset_ids) + per_page - 1) // per_page,'total':len(asset_ids)})
+        if path.startswith('/API/assets/v1/assets/') and path.count('/') == 6:
+            with server.lock:
+                found = path.strip('/').split('/')[-1] in server.assets
+            if not found:
+                return self.reply(404,{'errors':['No such asset']})
+            return self.reply(200,{'id':path.strip('/').split('/')[-1],'status':'ACTIVE','type':'ASSET'})
+        if path.endswith('/proxies/'):
+            with server.lock:
+                proxies = server.assets.get(path.strip('/').split('/')[-2])
+                if proxies is None:
+                    return self.reply(404,{'errors':['No such asset']})
+                objects = [{'id':proxy_id,'status':status} for proxy_id,status in proxies.items()]
+            return self.reply(200,{'objects':objects})
+        self.reply(404,{'errors':['Unknown call GET ' + path]})
+
+    def handle_upload(self, method, path):
+        server = self.server
+        if method == 'POST' and path.startswith('/gcs/start/'):
+            session_id = str(uuid.uuid4())
+            with server.lock:
+                server.sessions[session_id] = [0,None]
+            return self.reply(201,None,{'Location':server.base_url + 'gcs/session/' + session_id})
+        if method != 'PUT' or not path.startswith('/gcs/session/'):
+            return self.reply(404,{'errors':['Unknown upload call']})
+        session_id = path.rsplit('/',1)[1]
+        match = content_range_pattern.match(self.headers.get('Content-Range',''))
+        with server.lock:
+            session = server.sessions.get(session_id)
+            if session is None:
+                return self.reply(404,{'errors':['No such upload session']})
+            if match is None:
+                return self.reply(400,{'errors':['Bad Content-Range']})
+            total = int(match.group(4))
+            session[1] = total
+            #only accept a chunk that carries on from what we already have
+            if match.group(1) != '*' and int(match.group(2)) == session[0]:
+                session[0] = int(match.group(3)) + 1
+            committed = session[0]
+            if committed >= total:
+                server.stats['uploads'] += 1
+                del server.sessions[session_id]
+        if committed >= total:
+            return self.reply(200,{})
+        headers = {'Range':'bytes=0-' + str(committed - 1)} if committed else {}
+        self.reply(308,None,headers)
+
+    do_GET = handle_call
+    do_POST = handle_call
+    do_PUT = handle_call
+    do_PATCH = handle_call
+    do_DELETE = handle_call
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(conn, host, port, options):
+    server = FakeIconik((host,port),**options)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+def start(host='127.0.0.1', port=0, **options):
+    """
+    Runs the fake server in its own process so it doesn't count towards
+    the benchmark's CPU or memory.  Returns (process, base URL).
+    """
+    parent, child = multiprocessing.get_context('fork').Pipe()
+    process = multiprocessing.get_context('fork').Process(target=serve,args=(child,host,port,options),daemon=True)
+    process.start()
+    port = parent.recv()
+    return process, 'http://' + host + ':' + str(port) + '/'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake iconik and GCS server for benchmarks')
+    parser.add_argument('--host',dest='host',type=str,default='127.0.0.1',help="Address to listen on, default is 127.0.0.1")
+    parser.add_argument('--port',dest='port',type=int,default=8999,help="Port to listen on, default is 8999")
+    parser.add_argument('--latency',dest='latency',type=float,default=0,help="Milliseconds added to every response")
+    parser.add_argument('--jitter',dest='jitter',type=float,default=0,help="Random milliseconds either side of the latency")
+    parser.add_argument('--bandwidth',dest='bandwidth',type=float,default=0,help="Upload bandwidth cap in Mbit/s shared by all uploads, default is no cap")
+    parser.add_argument('--error-rate',dest='error_rate',type=float,default=0,help="Fraction of calls to fail with a 503")
+    parser.add_argument('--throttle-rate',dest='throttle_rate',type=float,default=0,help="Fraction of calls to answer with a 429")
+    parser.add_argument('--retry-after',dest='retry_after',type=int,default=1,help="Retry-After seconds sent with a 429")
+    cli_args = parser.parse_args()
+    server = FakeIconik((cli_args.host,cli_args.port),cli_args.latency / 1000,cli_args.jitter / 1000,cli_args.bandwidth * 125000,cli_args.error_rate,cli_args.throttle_rate,cli_args.retry_after)
+    print('Fake iconik listening on ' + server.base_url)
+    server.serve_forever()
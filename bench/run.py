@@ -0,0 +1,261 @@
+"""
+Offline benchmarks against bench/fakeiconik.py.  Each benchmark runs in a
+fresh process with its own state folder, and reports items per second,
+p50/p99 per item latency, request bytes per second and peak RSS:
+
+    python bench/run.py all --save baseline.json
+    python bench/run.py proxy --clips 100 --size-mb 20 --latency 80 --bandwidth 200 --compare baseline.json
+
+proxy runs proxy.create_proxies over generated WAV files, metadata runs
+metadata.push_metadata and delete runs aioiconik.delete_assets.  startup
+times fresh interpreters importing what each one-shot script needs and
+validating the token, and flags scripts whose p50 is over --budget-ms.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import fakeiconik
+
+benchmarks = ('proxy','metadata','delete','startup')
+
+#libraries each one-shot script loads before it starts on a clip
+startup_imports = {
+    'iconik-simple-proxy.py':'iconik, mediainfo, metrics, proxy, upload',
+    'catdv-metadata.py':'assetindex, iconik, metadata, metrics',
+    'iconik-asset-delete.py':'assetindex, iconik, metrics',
+}
+
+startup_code = '''
+import sys
+sys.path.insert(0,{root!r})
+import {modules}
+import store
+store.state_dir = {state!r}
+iconik.validate_token({url!r},{{'App-ID':'bench','Auth-Token':'bench'}})
+'''
+
+#metrics to compare against a baseline, and whether bigger is better
+metrics = [
+    ('items_per_sec',True),
+    ('p50_ms',False),
+    ('p99_ms',False),
+    ('bytes_per_sec',True),
+    ('max_rss_mb',False),
+]
+
+class Completions(logging.Handler):
+    """
+    Timestamps the log lines the library writes when an item finishes,
+    keyed on the item the pattern captures
+    """
+    def __init__(self, pattern):
+        super().__init__(logging.INFO)
+        self.pattern = re.compile(pattern)
+        self.done = {}
+
+    def emit(self, record):
+        match = self.pattern.match(record.getMessage())
+        if match:
+            self.done[match.group(1)] = time.monotonic()
+
+def stamped(items, key, started):
+    #record when the library pulls each item off our iterator
+    for item in items:
+        started[key(item)] = time.monotonic()
+        yield item
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1,int(round(fraction * (len(values) - 1))))]
+
+def make_clips(directory, count, size_mb):
+    """
+    Writes count stereo 48kHz WAV files of noise, so no two share content
+    """
+    paths = []
+    frames = int(size_mb * 1024 * 1024) // 4
+    for n in range(count):
+        path = os.path.join(directory,'clip' + str(n).zfill(6) + '.wav')
+        with wave.open(path,'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(48000)
+            w.writeframes(os.urandom(frames * 4))
+        paths.append(path)
+    return paths
+
+def run_proxy(cli_args, url, headers, work_dir):
+    import proxy
+    paths = make_clips(work_dir,cli_args.clips,cli_args.size_mb)
+    started = {}
+    latencies = []
+    failed = 0
+    for path, new_id, error in proxy.create_proxies(stamped(paths,lambda path: path,started),url,headers,cli_args.workers,cli_args.probe_workers,cli_args.api_workers):
+        latencies.append(time.monotonic() - started[path])
+        if error is not None:
+            failed += 1
+    return len(paths), failed, latencies
+
+def run_metadata(cli_args, url, headers, work_dir):
+    import metadata
+    completions = Completions(r'Updated metadata for iconik asset (\S+)')
+    logging.getLogger().addHandler(completions)
+    updates = []
+    for n in range(cli_args.updates):
+        fields = {'field' + str(i):['value ' + str(n) + ' ' + str(i)] for i in range(cli_args.fields)}
+        updates.append(('asset-' + str(n),metadata.build_metadata_payload(fields,'catdv_id',str(n))))
+    started = {}
+    results = metadata.push_metadata(url,headers,'bench-view',stamped(updates,lambda update: update[0],started),cli_args.concurrency)
+    failed = len([error for asset_id, error in results if error is not None])
+    latencies = [completions.done[asset_id] - started[asset_id] for asset_id in completions.done]
+    return len(updates), failed, latencies
+
+def run_delete(cli_args, url, headers, work_dir):
+    import aioiconik
+    completions = Completions(r'Deleted iconik asset (\S+)')
+    logging.getLogger().addHandler(completions)
+    asset_ids = ['asset-' + str(n) for n in range(cli_args.assets)]
+    started = {}
+    results = aioiconik.delete_assets(url,headers,stamped(asset_ids,lambda asset_id: asset_id,started),cli_args.concurrency)
+    failed = len([error for asset_id, error in results if error is not None])
+    latencies = [completions.done[asset_id] - started[asset_id] for asset_id in completions.done]
+    return len(asset_ids), failed, latencies
+
+def run_startup(cli_args, url, headers, work_dir):
+    root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    latencies = []
+    scripts = {}
+    for script, modules in startup_imports.items():
+        code = startup_code.format(root=root,modules=modules,state=os.path.join(work_dir,'state'),url=url)
+        times = []
+        for n in range(cli_args.runs):
+            start = time.monotonic()
+            subprocess.run([sys.executable,'-c',code],check=True)
+            times.append(time.monotonic() - start)
+        latencies.extend(times)
+        scripts[script] = round(percentile(times,0.5) * 1000,1)
+    over = [script for script, p50 in scripts.items() if p50 > cli_args.budget_ms]
+    return len(latencies), len(over), latencies, {'startup_p50_ms':scripts,'budget_ms':cli_args.budget_ms,'over_budget':over}
+
+runners = {
+    'proxy':run_proxy,
+    'metadata':run_metadata,
+    'delete':run_delete,
+    'startup':run_startup,
+}
+
+def run_benchmark(cli_args):
+    """
+    Runs one benchmark in this process and returns its result dict
+    """
+    with tempfile.TemporaryDirectory(prefix='iconik-bench-') as work_dir:
+        import iconik
+        import ratelimit
+        import store
+        store.state_dir = os.path.join(work_dir,'state')
+        ratelimit.enabled = cli_args.rate_limit
+        logging.getLogger().setLevel(logging.INFO)
+        logging.getLogger().addHandler(logging.NullHandler())
+
+        server, url = fakeiconik.start(latency=cli_args.latency / 1000,jitter=cli_args.jitter / 1000,bandwidth=cli_args.bandwidth * 125000,error_rate=cli_args.error_rate,throttle_rate=cli_args.throttle_rate,retry_after=cli_args.retry_after)
+        try:
+            headers = {'App-ID':'bench','Auth-Token':'bench'}
+            iconik.validate_token(url,headers)
+            start = time.monotonic()
+            items, failed, latencies, *extra = runners[cli_args.benchmark](cli_args,url,headers,work_dir)
+            seconds = time.monotonic() - start
+            stats = iconik.request('GET',url + '_stats').json()
+        finally:
+            server.terminate()
+    result = {
+        'benchmark':cli_args.benchmark,
+        'items':items,
+        'failed':failed,
+        'seconds':round(seconds,3),
+        'items_per_sec':round(items / seconds,2),
+        'p50_ms':round(percentile(latencies,0.5) * 1000,1) if latencies else None,
+        'p99_ms':round(percentile(latencies,0.99) * 1000,1) if latencies else None,
+        'bytes_per_sec':round(stats['bytes_in'] / seconds),
+        'max_rss_mb':round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,1),
+        'requests':stats['requests'],
+        'injected_errors':stats['errors'],
+        'injected_throttles':stats['throttled'],
+    }
+    for fields in extra:
+        result.update(fields)
+    return result
+
+def format_result(result, baseline=None):
+    lines = [result['benchmark'] + ': ' + str(result['items']) + ' items, ' + str(result['failed']) + ' failed, ' + str(result['seconds']) + 's, ' + str(result['requests']) + ' requests']
+    for metric, bigger_is_better in metrics:
+        line = '  ' + metric.ljust(14) + str(result[metric])
+        before = (baseline or {}).get(metric)
+        if before and result[metric] is not None:
+            change = (result[metric] - before) / before * 100
+            better = change > 0 if bigger_is_better else change < 0
+            line += '  (' + ('+' if change >= 0 else '') + str(round(change,1)) + '% vs baseline, ' + ('better' if better else 'worse') + ')'
+        lines.append(line)
+    for script, p50 in sorted(result.get('startup_p50_ms',{}).items()):
+        lines.append('  ' + script.ljust(24) + str(p50) + 'ms' + (' OVER BUDGET' if script in result['over_budget'] else ''))
+    return '\n'.join(lines)
+
+parser = argparse.ArgumentParser(description='Benchmark the sync scripts against a local fake iconik')
+parser.add_argument('benchmark',choices=benchmarks + ('all',),help="Benchmark to run")
+parser.add_argument('--clips',dest='clips',type=int,default=20,help="Proxies to create, default is 20")
+parser.add_argument('--size-mb',dest='size_mb',type=float,default=8,help="Size of each proxy in MB, default is 8")
+parser.add_argument('--workers',dest='workers',type=int,default=4,help="Upload workers for proxies, default is 4")
+parser.add_argument('--probe-workers',dest='probe_workers',type=int,help="Probe workers for proxies")
+parser.add_argument('--api-workers',dest='api_workers',type=int,help="API workers for proxies")
+parser.add_argument('--updates',dest='updates',type=int,default=2000,help="Metadata updates to push, default is 2000")
+parser.add_argument('--fields',dest='fields',type=int,default=20,help="Fields per metadata update, default is 20")
+parser.add_argument('--assets',dest='assets',type=int,default=2000,help="Assets to delete, default is 2000")
+parser.add_argument('--runs',dest='runs',type=int,default=10,help="Cold starts to time per script, default is 10")
+parser.add_argument('--budget-ms',dest='budget_ms',type=float,default=300,help="Cold start budget per script in milliseconds, default is 300")
+parser.add_argument('--concurrency',dest='concurrency',type=int,default=50,help="Concurrency for metadata and deletes, default is 50")
+parser.add_argument('--latency',dest='latency',type=float,default=20,help="Milliseconds the fake iconik adds to every call, default is 20")
+parser.add_argument('--jitter',dest='jitter',type=float,default=5,help="Random milliseconds either side of the latency, default is 5")
+parser.add_argument('--bandwidth',dest='bandwidth',type=float,default=0,help="Upload bandwidth cap in Mbit/s, default is no cap")
+parser.add_argument('--error-rate',dest='error_rate',type=float,default=0,help="Fraction of calls to fail with a 503")
+parser.add_argument('--throttle-rate',dest='throttle_rate',type=float,default=0,help="Fraction of calls to answer with a 429")
+parser.add_argument('--retry-after',dest='retry_after',type=int,default=1,help="Retry-After seconds sent with a 429, default is 1")
+parser.add_argument('--rate-limit',dest='rate_limit',default=False,action='store_true',help="Keep the client side rate limiter on")
+parser.add_argument('--save',dest='save',type=str,help="Write the results to this JSON file as a baseline")
+parser.add_argument('--compare',dest='compare',type=str,help="Compare the results with a baseline JSON file")
+parser.add_argument('--json',dest='json',default=False,action='store_true',help=argparse.SUPPRESS)
+
+if __name__ == '__main__':
+    cli_args = parser.parse_args()
+    if cli_args.json:
+        print(json.dumps(run_benchmark(cli_args)))
+        exit(0)
+
+    #every benchmark gets a fresh interpreter so peak RSS is its own
+    options = [arg for arg in sys.argv[2:]]
+    for flag in ('--save','--compare'):
+        while flag in options:
+            del options[options.index(flag):options.index(flag) + 2]
+    baseline = {}
+    if cli_args.compare:
+        with open(cli_args.compare,'r') as f:
+            baseline = json.load(f)
+    results = {}
+    for name in (benchmarks if cli_args.benchmark == 'all' else (cli_args.benchmark,)):
+        output = subprocess.run([sys.executable,os.path.realpath(__file__),name,'--json'] + options,stdout=subprocess.PIPE,check=True).stdout
+        results[name] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print(format_result(results[name],baseline.get(name)))
+    if cli_args.save:
+        with open(cli_args.save,'w') as f:
+            json.dump(results,f,indent=4,sort_keys=True)
@@ -1,23 +1,31 @@
-import configparser as ConfigParser
-import json
-import xml.etree.ElementTree as ET
 import argparse
-import requests
 import os
 import logging
 import logging.handlers
 
 #set up cli options
 parser = argparse.ArgumentParser(description='Parses CatDV xml and patches iconik metadata')
-parser.add_argument('-u','--iconik-id',dest='iconik_id',type=str,help="iconik asset id",required=True)
+parser.add_argument('-u','--iconik-id',dest='iconik_id',type=str,help="iconik asset id, default is the asset recorded for the CatDV clip in the local asset index")
 parser.add_argument('-a','--app-id',dest='app_id',type=str,help="iconik AppID")
 parser.add_argument('-t','--token',dest='token',type=str, help="iconik App Token")
-parser.add_argument('-x','--xml',dest='xml_path',type=str, help="path to catdv v1 xml file",required=True)
+parser.add_argument('-x','--xml',dest='xml_path',type=str, help="path to catdv v1 xml file")
 parser.add_argument('-v','--view',dest='iconik_view',type=str, help="iconik metadata view id")
 parser.add_argument('-i','--iconik-host',dest='host',type=str,help="URL for iconik domain, default is 'https://app.iconik.io'",default='https://app.iconik.io/')
-parser.add_argument('-c','--catdv-id',dest='catdvid',type=str,help="Unique ID from CatDV database",required=True)
+parser.add_argument('-c','--catdv-id',dest='catdvid',type=str,help="Unique ID from CatDV database")
+parser.add_argument('-m','--manifest',dest='manifest',type=str,help="CSV file of iconik asset id,CatDV id,xml path rows to update in one run")
+parser.add_argument('-b','--batch-xml',dest='batch_xml',type=str,help="path to a multi-clip catdv v1 xml export, each clip updates the iconik asset in its iconik ID field")
+parser.add_argument('--concurrency',dest='concurrency',type=int,help="Number of metadata updates to keep in flight in manifest and batch mode, default is 50",default=50)
+parser.add_argument('--full',dest='full',default=False,action='store_true',help="Send every mapped field, even ones that haven't changed since the last update")
 parser.add_argument('--debug',dest='debug',default=False,action='store_true',help="Enable log debug mode")
 cli_args = parser.parse_args()
+if cli_args.manifest is None and cli_args.batch_xml is None and None in (cli_args.xml_path,cli_args.catdvid):
+    parser.error('-x and -c are required unless a manifest is given with -m or an export with -b')
+
+#only import our libraries once the arguments are good, so --help and typos return straight away
+import assetindex
+import iconik
+import metadata
+import metrics
 
 #set up our log
 logger = logging.getLogger()
@@ -31,128 +39,73 @@ if cli_args.debug is True:
 else:
     logger.setLevel(logging.INFO)
 
-
-
-try:
-    config = ConfigParser.RawConfigParser(allow_no_value=True)
-    config.read(os.path.dirname(os.path.realpath(__file__)) + "/config/config.ini")
-    logger.info('Using config file ' + os.path.dirname(os.path.realpath(__file__)) + '/config/config.ini')
-
-    # define vars based on config file
-    xml_file = cli_args.xml_path
-    logger.debug('XML File: ' + xml_file)
-    app_id = config.get('iconik','app-id')
-    logger.debug('App-ID: ' + app_id)    
-    token = config.get('iconik','auth-token')
-    logger.debug('Auth-Token: ' + token)    
-    url = config.get('iconik','iconik-url')
-    logger.debug('URL: ' + url)    
-
-except Exception as e:
-    logger.debug(str(e))
-    # define vars based on cli inputs
-    logger.info('Could not open config file, falling back on cli arguments')
-    xml_file = cli_args.xml_path
-    app_id = cli_args.app_id
-    token = cli_args.token
-    url = cli_args.host
-
+#parse our config file, falling back on cli arguments
+config = iconik.load_config()
+settings = iconik.load_settings(config,cli_args)
+iconik.configure(config)
+metadata.configure(config)
+metrics.configure(config,os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs'))
+if cli_args.full is True:
+    metadata.incremental = False
 #validate our vars
-
 try:
-    app_id
-    if app_id == None:
-        logger.error('App-ID not set')
-        exit(1)
-except Exception as e:
-    logger.debug(str(e))
-    logger.error('App-ID is not defined')
+    iconik.check_settings(settings,['app_id','token','url','view_id'])
+except iconik.IconikException as e:
+    logger.error(str(e))
     exit(1)
-try:
-    token
-    if token == None:
-        logger.error('Auth-Token not set')
-        exit(1)
-except Exception as e:
-    logger.debug(str(e)) 
-    logger.error('Auth-Token not defined')
-    exit(1)    
-try:
-    url
-    if url == None:
-        logger.error('iconik URL not set')
-        exit(1)
-except Exception as e:
-    logger.debug(str(e))
-    logger.error('iconik URL not defined')
-    exit(1)    
-
-catdv_id_field = config.get('iconik','catdv-id-field')
-
-if config.get('iconik','view-id') is None:
-    iconik_view = cli_args.iconik_view
-else:
-    iconik_view = config.get('iconik','view-id')
 
 #config our headers for auth
-headers = {'App-ID':app_id,'Auth-Token':token}
+url = settings['url']
+headers = iconik.get_headers(settings)
 
-#load our metadata map
-logger.debug('Reading metadata map')
 try:
-    logger.debug('Attempting to read file ' + os.path.dirname(os.path.realpath(__file__)) + '/config/metadata-map.json')
-    with open(os.path.dirname(os.path.realpath(__file__)) + '/config/metadata-map.json','r') as json_file:  
-        metadata_map = json.load(json_file)
-except Exception as e:
-    logger.debug(str(e))
-    logger.error('Could not parse metadata map')
+    metadata_map = metadata.load_metadata_map()
+except metadata.MetadataException as e:
+    logger.error(str(e))
     exit(1)
-#get all of the mapped fields that exist in this xml
-logger.debug('Finding if mapped fields exist in CatDV metadata')
-catdv_fields = []
-for fields in metadata_map['field_map']:
-    logger.debug('Found field ' + fields['catdv_field_id'])
-    catdv_fields.append(fields['catdv_field_id'])
 
-#parse the xml, map the fields, build a new dict
-iconik_metadata = {}
-logger.info('Opening CatDV XML ' + xml_file)
-try:
-    tree = ET.parse(xml_file)
-except Exception as e:
-    logger.debug(str(e))
-    logging.error('Could not parse CatDV XML file ' + xml_file)
-    exit(1)
-root = tree.getroot()
-logger.debug('Looping through mapped CatDV fields and getting values')
-for clip in root:
-    for tags in clip:
-        if tags.tag in catdv_fields:
-            logger.debug('Found field ' + tags.tag + '. Contains value ' + tags.text)
-            iconik_metadata[next((item['iconik_field_id'] for item in metadata_map['field_map'] if item['catdv_field_id'] == tags.tag),None)] = tags.text
-
-#create iconik metadata json
-iconik_post_data = {
-    'metadata_values':{}
-}
-for field,value in iconik_metadata.items():
-    iconik_post_data['metadata_values'][field] = {'field_values':[{"value":value}]}
-
-if catdv_id_field is not None:
-    iconik_post_data['metadata_values'][catdv_id_field] = {'field_values':[{"value":cli_args.catdvid}]}
-
-logger.debug(json.dumps(iconik_post_data,indent=4,sort_keys=True))
+#manifest and batch mode, push every asset concurrently
+if cli_args.manifest is not None or cli_args.batch_xml is not None:
+    errors = []
+    if cli_args.manifest is not None:
+        try:
+            rows = metadata.read_manifest(cli_args.manifest)
+        except OSError as e:
+            logger.error('Could not read manifest: ' + str(e))
+            exit(1)
+        updates = metadata.manifest_updates(rows,metadata_map,settings['catdv_id_field'],errors)
+    else:
+        try:
+            iconik.check_settings(settings,['iconik_id_field'])
+        except iconik.IconikException as e:
+            logger.error(str(e))
+            exit(1)
+        updates = metadata.export_updates(cli_args.batch_xml,metadata_map,metadata.get_catdv_tag(settings['iconik_id_field']),settings['clip_id_tag'] or 'ID',settings['catdv_id_field'],errors)
+    results = metadata.push_metadata(url,headers,settings['view_id'],updates,cli_args.concurrency) + errors
+    for iconik_id,error in results:
+        print("@asset=" + iconik_id)
+        if error is not None:
+            print("@error=" + error)
+    failed = len([error for iconik_id,error in results if error is not None])
+    logger.info('Batch finished, ' + str(len(results) - failed) + ' succeeded and ' + str(failed) + ' failed')
+    exit(1 if failed else 0)
+
+#without -u fall back on the asset we recorded for this clip
+iconik_id = cli_args.iconik_id
+if iconik_id is None:
+    entries = assetindex.find(cli_args.catdvid)
+    if not entries:
+        logger.error('No iconik asset recorded for CatDV clip ' + cli_args.catdvid + ', pass one with -u')
+        exit(1)
+    if len(entries) > 1:
+        logger.warning('CatDV clip ' + cli_args.catdvid + ' has ' + str(len(entries)) + ' iconik assets, updating ' + entries[0]['asset_id'] + ', run iconik-reconcile.py to clean up')
+    iconik_id = entries[0]['asset_id']
 
-#post data to iconik
+#parse the xml and post data to iconik
+xml_file = cli_args.xml_path
+logger.debug('XML File: ' + xml_file)
 try:
-    logger.info('Updating metadata for iconik asset ' + cli_args.iconik_id)
-    r = requests.put(url + 'API/metadata/v1/assets/' + cli_args.iconik_id + '/assets/' + cli_args.iconik_id + '/views/' + iconik_view + '/',headers=headers,data=json.dumps(iconik_post_data,indent=4,sort_keys=True))
-    logger.debug('Respose text:\n' + r.text)
-    logger.info('Made call: ' + url + 'API/metadata/v1/assets/' + cli_args.iconik_id + '/assets/' + cli_args.iconik_id + '/views/' + iconik_view + '/')
-    logger.info('Response Status Code: ' + str(r.status_code))
-except Exception as e:
-    logger.debug(str(e))
-    logger.error('Error updating metadata in iconik for asset ' + cli_args.iconik_id)
-    if 'errors' in r.json():
-        logger.error(r.json()['errors'])
+    metadata.sync_xml(xml_file,metadata_map,url,headers,iconik_id,settings['view_id'],settings['catdv_id_field'],cli_args.catdvid)
+except metadata.MetadataException as e:
+    logger.error(str(e))
     exit(1)
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import time
+
+import store
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = logging.getLogger()
+
+#one reused read buffer per hash, large enough for sequential reads off a NAS
+buffer_size = 8 * 1024 * 1024
+
+#a fingerprint hashes this many evenly spread samples instead of the whole file
+sample_count = 16
+sample_size = 1024 * 1024
+
+schema = '''
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+'''
+
+class ChecksumException(Exception):
+    pass
+
+def new_hasher(algorithm):
+    if algorithm == 'xxhash':
+        if xxhash is None:
+            raise ChecksumException('xxhash checksums need the xxhash package installed')
+        return xxhash.xxh64()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ChecksumException('Unknown checksum algorithm ' + algorithm)
+
+def hash_file(path, algorithms=('md5',), stop=None):
+    """
+    Reads path once in fixed size blocks into a reused buffer and feeds
+    every requested algorithm ('md5', 'sha1', 'xxhash', ...) from the same
+    pass.  Returns a dict of algorithm: hex digest.  Setting the stop
+    event gives up between reads with ChecksumException.
+    """
+    hashers = {algorithm:new_hasher(algorithm) for algorithm in algorithms}
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path,'rb',buffering=0) as f:
+        while True:
+            if stop is not None and stop.is_set():
+                raise ChecksumException('Stopped hashing ' + path)
+            n = f.readinto(buf)
+            if not n:
+                break
+            for hasher in hashers.values():
+                hasher.update(view[:n])
+    return {algorithm:hasher.hexdigest() for algorithm,hasher in hashers.items()}
+
+def sample_file(path):
+    """
+    Returns a quick content fingerprint of path: its size plus a sha1 of
+    sample_count blocks spread from the start to the end of the file, or
+    of the whole file if it's smaller than the samples would be
+    """
+    size = os.path.getsize(path)
+    hasher = hashlib.sha1(str(size).encode('utf-8'))
+    with open(path,'rb',buffering=0) as f:
+        if size <= sample_count * sample_size:
+            hasher.update(f.read())
+        else:
+            for n in range(sample_count):
+                f.seek((size - sample_size) * n // (sample_count - 1))
+                hasher.update(f.read(sample_size))
+    return str(size) + '-' + hasher.hexdigest()
+
+def get_checksums(path, algorithms=('md5',), stop=None):
+    """
+    Returns a dict of algorithm: hex digest for path, only reading the file
+    for algorithms we haven't already hashed this exact file with.  A
+    cached digest is reused while the path, size, mtime and inode match.
+    'fingerprint' gives the sampled fingerprint from sample_file.
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    identity = (stat.st_size,stat.st_mtime_ns,stat.st_ino)
+    checksums = {}
+    with store.open_db('checksums',schema) as db:
+        for algorithm in algorithms:
+            row = db.execute('SELECT digest FROM checksums WHERE path = ? AND algorithm = ? AND size = ? AND mtime_ns = ? AND inode = ?',(path,algorithm) + identity).fetchone()
+            if row is not None:
+                checksums[algorithm] = row[0]
+    missing = [algorithm for algorithm in algorithms if algorithm not in checksums]
+    if not missing:
+        logger.debug('Using cached checksums for ' + path)
+        return checksums
+
+    start = time.monotonic()
+    if 'fingerprint' in missing:
+        checksums['fingerprint'] = sample_file(path)
+    if [algorithm for algorithm in missing if algorithm != 'fingerprint']:
+        checksums.update(hash_file(path,[algorithm for algorithm in missing if algorithm != 'fingerprint'],stop))
+    logger.debug('Hashed ' + path + ' in ' + str(round(time.monotonic() - start,2)) + ' seconds')
+    #only cache if the file didn't change while we were reading it
+    stat = os.stat(path)
+    if (stat.st_size,stat.st_mtime_ns,stat.st_ino) == identity:
+        with store.open_db('checksums',schema) as db:
+            db.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)',[(path,algorithm) + identity + (checksums[algorithm],time.time()) for algorithm in missing])
+    return checksums
+
+def get_checksum(path, algorithm='md5', stop=None):
+    return get_checksums(path,(algorithm,),stop)[algorithm]
+
+def get_fingerprint(path):
+    return get_checksums(path,('fingerprint',))['fingerprint']
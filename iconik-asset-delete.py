@@ -1,33 +1,78 @@
-import requests
-import configparser as ConfigParser
 import argparse
-import os
+
 #provide an interface to run from the cli without a config file
-parser = argparse.ArgumentParser(description='Create a new object in iconik with a proxy file.  Returns object ID on success')
-parser.add_argument('-u','--asset-id',dest='new_id',type=str,help="iconik asset id to delete",required=True)
+parser = argparse.ArgumentParser(description='Delete one or many assets from iconik')
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument('-u','--asset-id',dest='new_id',type=str,nargs='+',help="iconik asset id to delete, several can be given")
+source.add_argument('-f','--file',dest='id_file',type=str,help="Path to a text file listing one iconik asset id per line to delete as a batch")
+source.add_argument('-c','--catdv-id',dest='catdvid',type=str,help="Delete every asset recorded for this CatDV clip in the local asset index")
+parser.add_argument('--concurrency',dest='concurrency',type=int,help="Number of deletes to run at once in batch mode, default is 20",default=20)
 parser.add_argument('-a','--app-id',dest='app_id',type=str,help="iconik AppID")
 parser.add_argument('-t','--token',dest='token',type=str, help="iconik App Token")
 parser.add_argument('-i','--iconik-host',dest='host',type=str,help="URL for iconik domain, default is 'https://app.iconik.io'",default='https://app.iconik.io/')
 cli_args = parser.parse_args()
 
-try:
-    config = ConfigParser.RawConfigParser(allow_no_value=True)
-    config.read(os.path.dirname(os.path.realpath(__file__)) + "/config/config.ini")
-    # define vars based on config file
-    app_id = config.get('iconik','app-id')
-    token = config.get('iconik','auth-token')
-    url = config.get('iconik','iconik-url')
-except Exception as e:
-    # define vars based on cli inputs
-    app_id = cli_args.app_id
-    token = cli_args.token
-    url = cli_args.host
-
-new_id = cli_args.new_id
-headers = {'App-ID':app_id,'Auth-Token':token}
-
-try:
-    requests.delete(url + 'API/assets/v1/assets/' + new_id +'/',headers=headers)
-except Exception as e:
-    print(str(e))
-    exit(1)
\ No newline at end of file
+#only import our libraries once the arguments are good, so --help and typos return straight away
+import requests
+
+import assetindex
+import iconik
+import metrics
+
+config = iconik.load_config()
+settings = iconik.load_settings(config,cli_args)
+iconik.configure(config)
+metrics.configure(config)
+headers = iconik.get_headers(settings)
+
+if cli_args.catdvid is not None:
+    cli_args.new_id = [entry['asset_id'] for entry in assetindex.find(cli_args.catdvid)]
+    if not cli_args.new_id:
+        print('No iconik asset recorded for CatDV clip ' + cli_args.catdvid)
+        exit(1)
+
+#one id works like it always has, quietly with the exit code as the result
+if cli_args.new_id is not None and len(cli_args.new_id) == 1:
+    new_id = cli_args.new_id[0]
+    try:
+        with metrics.span('delete',asset_id=new_id) as fields:
+            r = iconik.delete_asset(settings['url'],headers,new_id)
+            if r.status_code >= 400:
+                fields['outcome'] = 'error'
+    except requests.exceptions.RequestException as e:
+        print(str(e))
+        exit(1)
+    if r.status_code >= 400:
+        print('Could not delete asset ' + new_id + ', iconik returned status ' + str(r.status_code) + ': ' + r.text)
+        exit(1)
+    assetindex.forget(new_id)
+    exit(0)
+
+#batch mode, print a result per asset
+if cli_args.id_file is not None:
+    try:
+        with open(cli_args.id_file,'r') as f:
+            asset_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    except OSError as e:
+        print('Could not read asset id file: ' + str(e))
+        exit(1)
+else:
+    asset_ids = cli_args.new_id
+
+#drop repeats so an id listed twice doesn't come back as a failed second delete
+asset_ids = list(dict.fromkeys(asset_ids))
+
+#aiohttp is only needed for batches, so single deletes keep starting fast
+import aioiconik
+
+failed = 0
+deleted = []
+for asset_id,error in aioiconik.delete_assets(settings['url'],headers,asset_ids,cli_args.concurrency):
+    print("@asset=" + asset_id)
+    if error is not None:
+        failed += 1
+        print("@error=" + error)
+    else:
+        deleted.append(asset_id)
+assetindex.forget_many(deleted)
+exit(1 if failed else 0)
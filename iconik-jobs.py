@@ -0,0 +1,38 @@
+import argparse
+import json
+import time
+
+#inspect and retry the worker-proxy.py job queue
+parser = argparse.ArgumentParser(description='List, retry and clean up jobs in the worker-proxy.py job queue')
+subparsers = parser.add_subparsers(dest='command',required=True)
+
+list_parser = subparsers.add_parser('list',help="List recent jobs")
+list_parser.add_argument('-s','--status',dest='status',type=str,choices=['queued','running','done','dead'],help="Only list jobs with this status")
+list_parser.add_argument('-n','--limit',dest='limit',type=int,default=100,help="Number of jobs to list, default is 100")
+
+retry_parser = subparsers.add_parser('retry',help="Put dead jobs back in the queue")
+retry_parser.add_argument('job_id',type=int,nargs='?',help="Job to retry, default is every dead job")
+
+purge_parser = subparsers.add_parser('purge',help="Forget finished jobs")
+purge_parser.add_argument('-d','--days',dest='days',type=float,default=30,help="Forget jobs finished more than this many days ago, default is 30")
+
+cli_args = parser.parse_args()
+
+import iconik
+import jobqueue
+
+jobqueue.configure(iconik.load_config())
+
+if cli_args.command == 'list':
+    for job in jobqueue.list_jobs(cli_args.status,cli_args.limit):
+        line = [str(job['id']),job['status'],job['kind'],job['key'],'attempts=' + str(job['attempts']),time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(job['updated']))]
+        if job['status'] == 'queued' and job['attempts']:
+            line.append('next=' + time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(job['next_run'])))
+        if job['last_error']:
+            line.append('error=' + json.dumps(job['last_error']))
+        print(' '.join(line))
+elif cli_args.command == 'retry':
+    count = jobqueue.retry_dead(cli_args.job_id)
+    print('Requeued ' + str(count) + ' jobs, a running worker-proxy.py will pick them up')
+elif cli_args.command == 'purge':
+    print('Forgot ' + str(jobqueue.purge(cli_args.days)) + ' finished jobs')
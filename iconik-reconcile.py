@@ -0,0 +1,151 @@
+import argparse
+import concurrent.futures
+import logging
+import logging.handlers
+import os
+import time
+
+#provide an interface to run from the cli without a config file
+parser = argparse.ArgumentParser(description='Compare the local asset index with iconik and fix orphans, duplicates and missing proxies')
+parser.add_argument('-a','--app-id',dest='app_id',type=str,help="iconik AppID")
+parser.add_argument('-t','--token',dest='token',type=str, help="iconik App Token")
+parser.add_argument('-i','--iconik-host',dest='host',type=str,help="URL for iconik domain, default is 'https://app.iconik.io'",default='https://app.iconik.io/')
+parser.add_argument('--per-page',dest='per_page',type=int,help="Assets to read from iconik per call, default is 500",default=500)
+parser.add_argument('--min-age',dest='min_age',type=float,help="Hours an asset must be left alone before it counts as an orphan or a missing proxy, default is 24",default=24)
+parser.add_argument('--check-proxies',dest='check_proxies',default=False,action='store_true',help="Also ask iconik for the proxies of every finished asset, one call per asset")
+parser.add_argument('--fix',dest='fix',default=False,action='store_true',help="Fix what is found instead of only reporting it")
+parser.add_argument('--delete-orphans',dest='delete_orphans',default=False,action='store_true',help="With --fix, also delete orphans.  Only safe once every upload passes its CatDV ID")
+parser.add_argument('--concurrency',dest='concurrency',type=int,help="Number of iconik calls to run at once for proxy checks and deletes, default is 20",default=20)
+parser.add_argument('-w','--workers',dest='workers',type=int,help="Number of missing proxies to upload again at once, default is 4",default=4)
+parser.add_argument('--debug',dest='debug',default=False,action='store_true',help="Enable log debug mode")
+cli_args = parser.parse_args()
+
+#check if log file exists
+if not os.path.exists(os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs')):
+    os.makedirs(os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs'))
+
+import aioiconik
+import assetindex
+import bandwidth
+import iconik
+import mediainfo
+import metrics
+import proxy
+import staging
+import upload
+
+#set up our log
+logger = logging.getLogger()
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler = logging.handlers.RotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + "/logs/reconcile.log", maxBytes=104857600, backupCount=5)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+if cli_args.debug is True:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+#parse our config file, falling back on cli arguments
+config = iconik.load_config()
+settings = iconik.load_settings(config,cli_args)
+iconik.configure(config)
+mediainfo.configure(config)
+upload.configure(config)
+staging.configure(config)
+#repairs are background work, they mustn't crowd out editors' uploads
+bandwidth.set_priority('bulk')
+metrics.configure(config,os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs'))
+
+try:
+    iconik.check_settings(settings,['app_id','token','url'])
+except iconik.IconikException as e:
+    logger.error(str(e))
+    print(str(e))
+    exit(1)
+
+url = settings['url']
+headers = iconik.get_headers(settings)
+
+try:
+    iconik.validate_token(url,headers)
+except iconik.IconikException as e:
+    logger.error(str(e))
+    print(str(e))
+    exit(1)
+
+#read the index before listing iconik, so anything created while we page isn't mistaken for drift
+cutoff = time.time() - cli_args.min_age * 3600
+entries = assetindex.live_entries()
+try:
+    iconik_ids = set([asset['id'] for asset in assetindex.iter_iconik_assets(url,headers,cli_args.per_page)])
+except iconik.IconikException as e:
+    logger.error(str(e))
+    print(str(e))
+    exit(1)
+indexed = set([entry['asset_id'] for entry in entries])
+logger.info('Index has ' + str(len(entries)) + ' live assets, iconik has ' + str(len(iconik_ids)))
+
+drift = assetindex.find_drift(entries,iconik_ids,cutoff)
+
+#finished proxies can only be checked one asset at a time, so that's opt in
+if cli_args.check_proxies:
+    flagged = set([entry['asset_id'] for entry in drift['missing'] + drift['duplicates'] + drift['orphans']])
+    finished = {entry['asset_id']:entry for entry in entries if entry['status'] == 'ok' and entry['asset_id'] in iconik_ids and entry['asset_id'] not in flagged}
+    for asset_id,count,error in aioiconik.count_proxies(url,headers,list(finished),cli_args.concurrency):
+        if error is None and count == 0:
+            drift['missing'].append(finished[asset_id])
+
+for entry in drift['gone']:
+    print('gone ' + entry['asset_id'] + ' catdv=' + str(entry['catdv_id']))
+for entry in drift['duplicates']:
+    print('duplicate ' + entry['asset_id'] + ' catdv=' + str(entry['catdv_id']) + ' keep=' + entry['keep'])
+for entry in drift['orphans']:
+    print('orphan ' + entry['asset_id'] + ' path=' + str(entry['path']))
+for entry in drift['missing']:
+    print('missing-proxy ' + entry['asset_id'] + ' catdv=' + str(entry['catdv_id']) + ' path=' + str(entry['path']))
+print(str(len(drift['gone'])) + ' gone, ' + str(len(drift['duplicates'])) + ' duplicates, ' + str(len(drift['orphans'])) + ' orphans, ' + str(len(drift['missing'])) + ' missing proxies, ' + str(len(iconik_ids - indexed)) + ' iconik assets not in the index')
+
+if not cli_args.fix:
+    exit(0)
+
+failed = 0
+
+#assets iconik no longer has just leave the index
+assetindex.forget_many([entry['asset_id'] for entry in drift['gone']])
+
+#an orphan may just be an asset uploaded without its CatDV ID that CatDV still points at, so those are only deleted when asked
+doomed = [entry['asset_id'] for entry in drift['duplicates'] + (drift['orphans'] if cli_args.delete_orphans else [])]
+if drift['orphans'] and not cli_args.delete_orphans:
+    logger.info('Leaving ' + str(len(drift['orphans'])) + ' orphaned assets alone, pass --delete-orphans to delete them')
+if doomed:
+    logger.info('Deleting ' + str(len(doomed)) + ' duplicate and orphaned assets')
+    deleted = []
+    for asset_id,error in aioiconik.delete_assets(url,headers,doomed,cli_args.concurrency):
+        if error is None:
+            deleted.append(asset_id)
+        else:
+            failed += 1
+            print('error ' + asset_id + ' ' + error)
+    assetindex.forget_many(deleted)
+
+#missing proxies are uploaded again to the same asset, so CatDV's iconik ID stays good
+def repair(entry):
+    if entry['path'] is None or not os.path.isfile(entry['path']):
+        raise proxy.ProxyException('Proxy file ' + str(entry['path']) + ' is gone, create the asset again from CatDV')
+    #an AWAITED proxy from the stalled upload would never finish
+    if entry['status'] == 'uploading' and entry['proxy_id'] is not None:
+        proxy.delete_proxy(url,headers,entry['asset_id'],entry['proxy_id'])
+    upload.clear_session(entry['path'])
+    return proxy.repair_proxy(entry['path'],url,headers,entry['asset_id'])
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=cli_args.workers) as pool:
+    futures = {pool.submit(repair,entry):entry for entry in drift['missing']}
+    for future in concurrent.futures.as_completed(futures):
+        entry = futures[future]
+        try:
+            print('repaired ' + entry['asset_id'] + ' proxy=' + future.result())
+        except proxy.ProxyException as e:
+            failed += 1
+            logger.error('Could not repair proxy of ' + entry['asset_id'] + ': ' + str(e))
+            print('error ' + entry['asset_id'] + ' ' + str(e))
+exit(1 if failed else 0)
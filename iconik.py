@@ -0,0 +1,262 @@
+import configparser as ConfigParser
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import ratelimit
+import store
+
+logger = logging.getLogger()
+
+base_dir = os.path.dirname(os.path.realpath(__file__))
+config_file = os.path.join(base_dir,'config','config.ini')
+default_url = 'https://app.iconik.io/'
+
+#human readable names for our required settings, used in error logging
+setting_names = {
+    'app_id':'App-ID',
+    'token':'Auth-Token',
+    'url':'iconik URL',
+    'view_id':'iconik view ID',
+    'iconik_id_field':'iconik ID field',
+    'iconik_url_field':'iconik URL field',
+    'isg_storage_id':'iconik storage ID',
+    'isg_root':'iconik storage root',
+}
+
+#connection pool and retry tuning, overridden by the [http] section of config.ini
+pool_size = 10
+retries = 5
+backoff = 0.5
+timeout = (10, 120)
+retry_statuses = (429, 500, 502, 503, 504)
+
+session = None
+upload_session = None
+session_lock = threading.Lock()
+
+#seconds to trust a token we already validated, overridden by token-cache-ttl in the [iconik] section
+token_ttl = 3600
+
+token_schema = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    token_hash TEXT NOT NULL,
+    url TEXT NOT NULL,
+    validated REAL NOT NULL,
+    PRIMARY KEY (token_hash, url)
+);
+'''
+
+class IconikException(Exception):
+    pass
+
+class IconikRetry(Retry):
+    """
+    Retry policy that also retries POSTs, but only when iconik rejected
+    the request outright with a 429, so we never create an object twice
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == 'POST':
+            if status_code != 429:
+                return False
+            method = 'GET'
+        return super().is_retry(method,status_code,has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        #tell every other worker to back off too
+        if response is not None and response.status == 429:
+            ratelimit.throttle(ratelimit.get_bucket(method,url or ''),self.get_retry_after(response))
+        return super().increment(method,url,response,*args,**kwargs)
+
+def configure(config):
+    """
+    Reads the optional [http] and [ratelimit] sections of config.ini,
+    call before the first request
+    """
+    global pool_size, retries, backoff, timeout, token_ttl
+    pool_size = config.getint('http','pool-size',fallback=pool_size)
+    retries = config.getint('http','retries',fallback=retries)
+    backoff = config.getfloat('http','backoff',fallback=backoff)
+    timeout = (config.getfloat('http','connect-timeout',fallback=timeout[0]),config.getfloat('http','read-timeout',fallback=timeout[1]))
+    token_ttl = config.getint('iconik','token-cache-ttl',fallback=token_ttl)
+    ratelimit.configure(config)
+
+def new_session(max_retries):
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size,max_retries=max_retries)
+    s.mount('https://',adapter)
+    s.mount('http://',adapter)
+    return s
+
+def get_session():
+    """
+    Returns the shared keep-alive session for iconik API calls, retrying
+    connection errors and 429/5xx responses with backoff and honoring
+    Retry-After
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = new_session(IconikRetry(total=retries,backoff_factor=backoff,status_forcelist=retry_statuses,allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'PATCH'},respect_retry_after_header=True,raise_on_status=False))
+        return session
+
+def get_upload_session():
+    """
+    Returns the shared keep-alive session for storage uploads.  It only
+    retries failed connections, upload.py handles everything else so it
+    can resume from the committed offset.
+    """
+    global upload_session
+    with session_lock:
+        if upload_session is None:
+            upload_session = new_session(Retry(total=retries,connect=retries,read=0,status=0,backoff_factor=backoff,raise_on_status=False))
+        return upload_session
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout',timeout)
+    ratelimit.acquire(ratelimit.get_bucket(method,url))
+    r = get_session().request(method,url,**kwargs)
+    #a revoked token shouldn't stay trusted until its cache entry runs out
+    if r.status_code == 401 and kwargs.get('headers'):
+        forget_token(kwargs['headers'])
+    return r
+
+def load_config(path=config_file):
+    """
+    Returns a parsed config.ini, empty if the file does not exist
+    """
+    config = ConfigParser.RawConfigParser(allow_no_value=True)
+    config.read(path)
+    return config
+
+#setting name, config section, config key and cli argument for each setting
+setting_sources = [
+    ('app_id','iconik','app-id','app_id'),
+    ('token','iconik','auth-token','token'),
+    ('url','iconik','iconik-url','host'),
+    ('view_id','iconik','view-id','iconik_view'),
+    ('catdv_id_field','iconik','catdv-id-field',None),
+    ('iconik_id_field','catdv','iconik-id-field','iconik_id_field'),
+    ('iconik_url_field','catdv','iconik-url-field','iconik_url_field'),
+    ('clip_id_tag','catdv','clip-id-tag',None),
+    ('isg_storage_id','iconik','isg-storage-id',None),
+    ('isg_root','iconik','isg-root',None),
+]
+
+def load_settings(config, cli_args=None):
+    """
+    Returns a dict of settings from config.ini, falling back on cli
+    arguments for anything the config file doesn't set
+    """
+    if config.has_section('iconik'):
+        logger.info('Using config file ' + config_file)
+    else:
+        logger.info('Could not open config file, falling back on cli arguments')
+    settings = {}
+    for name,section,key,arg in setting_sources:
+        settings[name] = config.get(section,key,fallback=None) or getattr(cli_args,arg or name,None)
+    settings['use_isg'] = config.getboolean('iconik','use-isg',fallback=False)
+    return settings
+
+def check_settings(settings, required):
+    """
+    Raises IconikException for the first required setting that is missing
+    """
+    for key in required:
+        if not settings.get(key):
+            raise IconikException(setting_names.get(key,key) + ' not set')
+
+def get_headers(settings):
+    return {'App-ID':settings['app_id'],'Auth-Token':settings['token']}
+
+#only a hash of the credentials is stored
+def get_token_hash(headers):
+    return hashlib.sha256((str(headers.get('App-ID')) + '\n' + str(headers.get('Auth-Token'))).encode('utf-8')).hexdigest()
+
+def forget_token(headers):
+    if 'Auth-Token' not in headers:
+        return
+    with store.open_db('auth',token_schema) as db:
+        db.execute('DELETE FROM tokens WHERE token_hash = ?',(get_token_hash(headers),))
+
+def validate_token(url, headers):
+    """
+    Checks our App-ID and Auth-Token against iconik, raises IconikException
+    if iconik is unreachable or rejects them.  A token that passed in the
+    last token_ttl seconds isn't checked again, so a one-shot script
+    doesn't spend a round trip on it every run.
+    """
+    token_hash = get_token_hash(headers)
+    if token_ttl > 0:
+        with store.open_db('auth',token_schema) as db:
+            row = db.execute('SELECT validated FROM tokens WHERE token_hash = ? AND url = ?',(token_hash,url)).fetchone()
+        if row is not None and time.time() - row[0] < token_ttl:
+            logger.debug('Using cached validation of iconik token')
+            return
+    try:
+        r = request('GET',url + 'API/auth/v1/auth/token/',headers=headers)
+        response = r.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.debug(str(e))
+        raise IconikException('Could not connect to iconik')
+    if len(response) == 0:
+        raise IconikException('iconik Auth Key or Token invalid')
+    if 'errors' in response:
+        raise IconikException(str(response['errors']))
+    if token_ttl > 0:
+        with store.open_db('auth',token_schema) as db:
+            db.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',(token_hash,url,time.time()))
+
+def get_asset_url(asset_id):
+    return 'https://app.iconik.io/asset/' + asset_id + '/'
+
+def create_asset(url, headers, data):
+    return request('POST',url + 'API/assets/v1/assets/',headers=headers,data=json.dumps(data))
+
+def update_asset(url, headers, asset_id, data):
+    return request('PATCH',url + 'API/assets/v1/assets/' + asset_id + '/',headers=headers,data=json.dumps(data))
+
+def create_proxy(url, headers, asset_id, data):
+    return request('POST',url + 'API/files/v1/assets/' + asset_id + '/proxies/',headers=headers,data=json.dumps(data))
+
+def update_proxy(url, headers, asset_id, proxy_id, data):
+    return request('PATCH',url + 'API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id + '/',headers=headers,data=json.dumps(data))
+
+def create_keyframes(url, headers, asset_id, proxy_id):
+    return request('POST',url + 'API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id + '/keyframes/',headers=headers)
+
+def create_format(url, headers, asset_id, data):
+    return request('POST',url + 'API/files/v1/assets/' + asset_id + '/formats/',headers=headers,data=json.dumps(data))
+
+def create_file_set(url, headers, asset_id, data):
+    return request('POST',url + 'API/files/v1/assets/' + asset_id + '/file_sets/',headers=headers,data=json.dumps(data))
+
+def create_file(url, headers, asset_id, data):
+    return request('POST',url + 'API/files/v1/assets/' + asset_id + '/files/',headers=headers,data=json.dumps(data))
+
+def start_resumable_upload(upload_url):
+    return request('POST',upload_url,headers={'x-goog-resumable':'start','Content-Length':'0'})
+
+def get_asset(url, headers, asset_id):
+    return request('GET',url + 'API/assets/v1/assets/' + asset_id + '/',headers=headers)
+
+def list_assets(url, headers, page=1, per_page=500):
+    return request('GET',url + 'API/assets/v1/assets/',headers=headers,params={'page':page,'per_page':per_page})
+
+def get_proxies(url, headers, asset_id):
+    return request('GET',url + 'API/files/v1/assets/' + asset_id + '/proxies/',headers=headers)
+
+def delete_asset(url, headers, asset_id):
+    return request('DELETE',url + 'API/assets/v1/assets/' + asset_id + '/',headers=headers)
+
+def delete_proxy(url, headers, asset_id, proxy_id):
+    return request('DELETE',url + 'API/files/v1/assets/' + asset_id + '/proxies/' + proxy_id,headers=headers)
+
+def put_metadata(url, headers, asset_id, view_id, payload):
+    return request('PUT',url + 'API/metadata/v1/assets/' + asset_id + '/assets/' + asset_id + '/views/' + view_id + '/',headers=headers,data=json.dumps(payload,indent=4,sort_keys=True))
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import random
+import time
+
+import store
+
+logger = logging.getLogger()
+
+#retry tuning, overridden by the [queue] section of config.ini
+max_attempts = 8
+backoff = 30.0
+max_backoff = 3600.0
+#a running job whose worker hasn't finished it by then is assumed to have crashed
+lease = 7200.0
+
+#jobs of these kinds run again when re-queued after finishing, the others return their stored result
+repeatable_kinds = ('metadata',)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run REAL NOT NULL,
+    lease_until REAL,
+    owner TEXT,
+    result TEXT,
+    last_error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_run);
+CREATE TABLE IF NOT EXISTS dead_jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created REAL NOT NULL,
+    died REAL NOT NULL
+);
+'''
+
+columns = ('id','kind','key','payload','status','attempts','next_run','lease_until','owner','result','last_error','created','updated')
+
+class JobException(Exception):
+    pass
+
+class JobBusy(JobException):
+    pass
+
+def configure(config):
+    """
+    Reads the optional [queue] section of config.ini
+    """
+    global max_attempts, backoff, max_backoff, lease
+    max_attempts = config.getint('queue','max-attempts',fallback=max_attempts)
+    backoff = config.getfloat('queue','backoff',fallback=backoff)
+    max_backoff = config.getfloat('queue','max-backoff',fallback=max_backoff)
+    lease = config.getfloat('queue','lease',fallback=lease)
+
+def open_queue():
+    return store.open_db('jobs',schema)
+
+def to_job(row):
+    if row is None:
+        return None
+    job = dict(zip(columns,row))
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result']) if job['result'] is not None else None
+    return job
+
+def get_job(job_id):
+    with open_queue() as db:
+        return to_job(db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE id = ?',(job_id,)).fetchone())
+
+def enqueue(kind, key, payload):
+    """
+    Adds a job, using (kind, key) as its idempotency key, and returns it.
+    A queued job with the same key has its payload replaced.  A finished
+    job is returned as is, unless its kind is repeatable, and a dead
+    job is brought back from the dead letters for another go.
+    """
+    now = time.time()
+    with open_queue() as db:
+        row = db.execute('SELECT id, status FROM jobs WHERE kind = ? AND key = ?',(kind,key)).fetchone()
+        if row is None:
+            db.execute('INSERT INTO jobs (kind, key, payload, status, next_run, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',(kind,key,json.dumps(payload),'queued',now,now,now))
+        elif row[1] == 'done' and kind not in repeatable_kinds:
+            logger.info('Job ' + kind + ' ' + key + ' already finished, not running it again')
+        elif row[1] == 'running':
+            logger.info('Job ' + kind + ' ' + key + ' is already running')
+        else:
+            db.execute('UPDATE jobs SET payload = ?, status = ?, attempts = 0, next_run = ?, last_error = NULL, updated = ? WHERE id = ?',(json.dumps(payload),'queued',now,now,row[0]))
+            db.execute('DELETE FROM dead_jobs WHERE id = ?',(row[0],))
+        return to_job(db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE kind = ? AND key = ?',(kind,key)).fetchone())
+
+def claim(job_id=None, kinds=None):
+    """
+    Marks a job as running and returns it, either job_id or the next due
+    job.  Jobs whose lease ran out (their worker crashed) are claimable
+    again.  Returns None if there is nothing to claim.
+    """
+    now = time.time()
+    owner = os.uname().nodename + ':' + str(os.getpid())
+    with open_queue() as db:
+        #take the write lock first so two workers can't claim the same job
+        db.execute('BEGIN IMMEDIATE')
+        query = 'SELECT id FROM jobs WHERE ((status = ? AND next_run <= ?) OR (status = ? AND lease_until < ?))'
+        params = ['queued',now,'running',now]
+        if job_id is not None:
+            query += ' AND id = ?'
+            params.append(job_id)
+        if kinds:
+            query += ' AND kind IN (' + ','.join('?' * len(kinds)) + ')'
+            params.extend(kinds)
+        row = db.execute(query + ' ORDER BY next_run LIMIT 1',params).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, owner = ?, updated = ? WHERE id = ?',('running',now + lease,owner,now,row[0]))
+        return to_job(db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE id = ?',(row[0],)).fetchone())
+
+def pid_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def recover():
+    """
+    Requeues running jobs left behind by a crashed process on this host,
+    without waiting for their lease to run out.  Returns how many.
+    """
+    host = os.uname().nodename
+    now = time.time()
+    count = 0
+    with open_queue() as db:
+        for job_id, owner in db.execute('SELECT id, owner FROM jobs WHERE status = ?',('running',)).fetchall():
+            owner_host, _, pid = (owner or '').rpartition(':')
+            if owner_host != host or not pid.isdigit() or pid_alive(int(pid)):
+                continue
+            db.execute('UPDATE jobs SET status = ?, next_run = ?, lease_until = NULL, updated = ? WHERE id = ?',('queued',now,now,job_id))
+            count += 1
+    return count
+
+def complete(job, result):
+    with open_queue() as db:
+        db.execute('UPDATE jobs SET status = ?, result = ?, lease_until = NULL, last_error = NULL, updated = ? WHERE id = ?',('done',json.dumps(result),time.time(),job['id']))
+
+def fail(job, error):
+    """
+    Schedules a failed job for another attempt with exponential backoff,
+    or moves it to the dead letters once it is out of attempts
+    """
+    now = time.time()
+    with open_queue() as db:
+        if job['attempts'] >= max_attempts:
+            logger.error('Job ' + job['kind'] + ' ' + job['key'] + ' failed ' + str(job['attempts']) + ' times, moving to dead letters: ' + error)
+            db.execute('UPDATE jobs SET status = ?, lease_until = NULL, last_error = ?, updated = ? WHERE id = ?',('dead',error,now,job['id']))
+            db.execute('INSERT OR REPLACE INTO dead_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',(job['id'],job['kind'],job['key'],json.dumps(job['payload']),job['attempts'],error,job['created'],now))
+            return
+        delay = min(max_backoff,backoff * (2 ** (job['attempts'] - 1))) * random.uniform(0.8,1.2)
+        logger.warning('Job ' + job['kind'] + ' ' + job['key'] + ' failed, retrying in ' + str(int(delay)) + ' seconds: ' + error)
+        db.execute('UPDATE jobs SET status = ?, next_run = ?, lease_until = NULL, last_error = ?, updated = ? WHERE id = ?',('queued',now + delay,error,now,job['id']))
+
+def run(job, handlers):
+    """
+    Runs a claimed job with handlers[kind](payload) and records the
+    outcome.  Returns the handler's result or raises JobException.
+    """
+    try:
+        result = handlers[job['kind']](job['payload'])
+    except Exception as e:
+        fail(job,str(e) or type(e).__name__)
+        raise JobException(str(e) or type(e).__name__)
+    complete(job,result)
+    return result
+
+def find_job(kind, key):
+    with open_queue() as db:
+        return to_job(db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE kind = ? AND key = ?',(kind,key)).fetchone())
+
+def start(kind, key, payload, rerun=False):
+    """
+    Queues a job and claims it for this process in one transaction, so
+    the background worker can't take it in between.  A finished job is
+    returned as is instead, unless its kind is repeatable or rerun is
+    True.  Raises JobBusy if the job is running elsewhere.
+    """
+    now = time.time()
+    owner = os.uname().nodename + ':' + str(os.getpid())
+    with open_queue() as db:
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute('SELECT id, status, lease_until, result FROM jobs WHERE kind = ? AND key = ?',(kind,key)).fetchone()
+        if row is None:
+            db.execute('INSERT INTO jobs (kind, key, payload, status, attempts, next_run, lease_until, owner, created, updated) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)',(kind,key,json.dumps(payload),'running',now,now + lease,owner,now,now))
+        elif row[1] == 'done' and row[3] is not None and kind not in repeatable_kinds and not rerun:
+            logger.info('Job ' + kind + ' ' + key + ' already finished, not running it again')
+        elif row[1] == 'running' and row[2] is not None and row[2] >= now:
+            raise JobBusy('Job ' + kind + ' ' + key + ' is already running')
+        else:
+            db.execute('UPDATE jobs SET payload = ?, status = ?, attempts = 1, next_run = ?, lease_until = ?, owner = ?, last_error = NULL, updated = ? WHERE id = ?',(json.dumps(payload),'running',now,now + lease,owner,now,row[0]))
+            db.execute('DELETE FROM dead_jobs WHERE id = ?',(row[0],))
+        return to_job(db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE kind = ? AND key = ?',(kind,key)).fetchone())
+
+def submit(kind, key, payload, handlers, checks=None):
+    """
+    Durably queues a job and runs it right away, returning its result.
+    A job that already finished returns its stored result, as long as
+    checks[kind](job), when given, says the result still stands.
+    Failures stay queued for retry and raise JobException, a job that is
+    running elsewhere raises JobBusy.
+    """
+    rerun = False
+    if checks and kind in checks:
+        #checks may call iconik, so they run before the write lock is taken
+        job = find_job(kind,key)
+        if job is not None and job['status'] == 'done' and job['result'] is not None:
+            rerun = not checks[kind](job)
+    job = start(kind,key,payload,rerun)
+    if job['status'] == 'done':
+        return job['result']
+    return run(job,handlers)
+
+def retire(kind, keys):
+    """
+    Forgets finished jobs of kind under any of keys, so the next submit
+    runs them again
+    """
+    with open_queue() as db:
+        db.executemany('DELETE FROM jobs WHERE kind = ? AND key = ? AND status = ?',[(kind,key,'done') for key in keys if key])
+
+def work(handlers, kinds=None, stop=None, poll=5.0, drain=False):
+    """
+    Runs due jobs until stop is set, or until nothing is due when drain
+    is True.  Returns the number of jobs run.
+    """
+    count = 0
+    while stop is None or not stop.is_set():
+        job = claim(kinds=kinds)
+        if job is None:
+            if drain:
+                break
+            if stop is not None:
+                stop.wait(poll)
+            else:
+                time.sleep(poll)
+            continue
+        logger.info('Running queued job ' + job['kind'] + ' ' + job['key'] + ', attempt ' + str(job['attempts']))
+        try:
+            run(job,handlers)
+        except JobException:
+            pass
+        count += 1
+    return count
+
+def list_jobs(status=None, limit=100):
+    with open_queue() as db:
+        if status is None:
+            rows = db.execute('SELECT ' + ','.join(columns) + ' FROM jobs ORDER BY updated DESC LIMIT ?',(limit,)).fetchall()
+        else:
+            rows = db.execute('SELECT ' + ','.join(columns) + ' FROM jobs WHERE status = ? ORDER BY updated DESC LIMIT ?',(status,limit)).fetchall()
+    return [to_job(row) for row in rows]
+
+def retry_dead(job_id=None):
+    """
+    Puts dead jobs (or just job_id) back in the queue, returns how many
+    """
+    now = time.time()
+    with open_queue() as db:
+        if job_id is None:
+            ids = [row[0] for row in db.execute('SELECT id FROM dead_jobs').fetchall()]
+        else:
+            ids = [row[0] for row in db.execute('SELECT id FROM dead_jobs WHERE id = ?',(job_id,)).fetchall()]
+        for dead_id in ids:
+            db.execute('UPDATE jobs SET status = ?, attempts = 0, next_run = ?, updated = ? WHERE id = ?',('queued',now,now,dead_id))
+            db.execute('DELETE FROM dead_jobs WHERE id = ?',(dead_id,))
+    return len(ids)
+
+def purge(days):
+    """
+    Forgets finished jobs older than days, returns how many
+    """
+    with open_queue() as db:
+        return db.execute('DELETE FROM jobs WHERE status = ? AND updated < ?',('done',time.time() - days * 86400)).rowcount
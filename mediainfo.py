@@ -1,32 +1,144 @@
+import atexit
+import concurrent.futures
 import json
 import logging
-import logging.handlers
 import multiprocessing
 import os
 import signal
 import re
+import shutil
+import sqlite3
+import threading
+import time
 from pymediainfo import MediaInfo
 from pymediainfo import Track
 
-#set up our log
-logger = logging.getLogger("iconik-proxy")
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler = logging.handlers.RotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + "/logs/proxy.log", maxBytes=104857600,backupCount=5)
-handler.setFormatter(formatter)
-logger.setLevel(logging.INFO)
-logger.addHandler(handler)
+import store
+
+#the calling script sets up where our log goes
+logger = logging.getLogger()
+
+#number of files to keep parsed results for, least recently used are dropped first
+cache_size = 10000
+
+#mediainfo runs in a pool of worker processes so a file that hangs it can be killed
+probe_workers = os.cpu_count() or 1
+probe_timeout = 300
+probe_pool = None
+probe_pool_lock = threading.Lock()
+
+#used when a lowres video doesn't report its frame rate
+FALLBACK_VIDEO_FRAME_RATE = '25'
+
+class MediaInfoException(Exception):
+    pass
+
+class MediaInfoTimeout(MediaInfoException):
+    pass
+
+cache_schema = '''
+CREATE TABLE IF NOT EXISTS mediainfo (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    media_info TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mediainfo_last_used ON mediainfo (last_used);
+'''
+
+def configure(config):
+    """
+    Reads the optional [mediainfo] section of config.ini
+    """
+    global cache_size, probe_workers, probe_timeout
+    cache_size = config.getint('mediainfo','cache-size',fallback=cache_size)
+    probe_workers = max(1, config.getint('mediainfo','probe-workers',fallback=probe_workers))
+    probe_timeout = config.getfloat('mediainfo','probe-timeout',fallback=probe_timeout)
+
+#looked up on the first probe instead of at startup, runs that never probe don't pay for it
+installed = None
+
+def check_installed():
+    """
+    Raises MediaInfoException if mediainfo isn't in the path
+    """
+    global installed
+    if installed is None:
+        installed = shutil.which('mediainfo') is not None
+    if not installed:
+        raise MediaInfoException('You need to have mediainfo installed and available in your path to read proxies')
+
+timecode_pattern = re.compile(r'(\d\d)([:;,\.])(\d\d)([:;,\.])(\d\d)([:;,\.])(\d\d)')
+
+
+class TrackInfo(object):
+    """
+
+    Compact copy of the track fields we actually read
+
+    """
+
+    __slots__ = ('track_type', 'type', 'format', 'codec_family', 'bit_rate', 'bit_depth',
+                 'sampling_rate', 'duration', 'width', 'height', 'frame_rate',
+                 'time_code_of_first_frame', 'delay_dropframe', 'delay_settings')
+
+    def __init__(self, track):
+        for name in self.__slots__:
+            setattr(self, name, getattr(track, name, None))
+
+
+class TrackIndex(object):
+    """
+
+    Tracks of a MediaInfo result indexed by type in a
+    single pass, so helpers don't rescan the track list
+
+    """
+
+    __slots__ = ('tracks', 'by_type', 'timecode_track', 'last_video_track')
+
+    def __init__(self, media_info):
+        self.tracks = []
+        self.by_type = {}
+        self.timecode_track = None
+        self.last_video_track = None
+        for track in media_info.tracks:
+            info = TrackInfo(track)
+            self.tracks.append(info)
+            self.by_type.setdefault(info.track_type, info)
+            if info.track_type == "Other" and info.type == "Time code":
+                self.timecode_track = info
+            if info.track_type == "Video":
+                self.last_video_track = info
+
+    def get(self, track_type):
+        return self.by_type.get(track_type)
+
+
+def get_track_index(media_info):
+    """
+
+    Returns the TrackIndex for a MediaInfo object, building
+    it the first time. Also accepts a TrackIndex.
+
+    """
+
+    if isinstance(media_info, TrackIndex):
+        return media_info
+    index = media_info.__dict__.get('track_index')
+    if index is None:
+        index = TrackIndex(media_info)
+        media_info.track_index = index
+    return index
+
 
 def get_start_time_code(media_info):
-    tc_track = None
-    video_track = None
+    index = get_track_index(media_info)
+    tc_track = index.timecode_track
+    video_track = index.last_video_track
     tc = None
 
-    for track in media_info.tracks:
-        if track.track_type == "Other" and track.type == "Time code":
-            tc_track = track
-        if track.track_type == "Video":
-            video_track = track
-
     if tc_track and tc_track.time_code_of_first_frame:
         tc = tc_track.time_code_of_first_frame
 
@@ -34,7 +146,7 @@ def get_start_time_code(media_info):
         tc = video_track.time_code_of_first_frame
 
     if tc:
-        match = re.search('(\d\d)([:;,\.])(\d\d)([:;,\.])(\d\d)([:;,\.])(\d\d)', tc)
+        match = timecode_pattern.search(tc)
         if match:
             logger.debug("Matched timecode: %s" % str(match))
             if match.group(6) in [";", ","]:
@@ -58,9 +170,7 @@ def get_track(media_info, track_type):
     """
     Returns a track object for a requested track type
     """
-    for track in media_info.tracks:
-        if track.track_type == track_type:
-            return track
+    return get_track_index(media_info).get(track_type)
 
 
 def get_duration(media_info):
@@ -71,12 +181,11 @@ def get_duration(media_info):
 
     """
 
-    if get_track(media_info, 'Video'):
-        return get_track(media_info, 'Video').duration
-    elif get_track(media_info, 'Audio'):
-        return get_track(media_info, 'Audio').duration
-    else:
-        return None
+    index = get_track_index(media_info)
+    track = index.get('Video') or index.get('Audio')
+    if track:
+        return track.duration
+    return None
 
 
 def get_image_resolution(media_info):
@@ -86,27 +195,76 @@ def get_image_resolution(media_info):
 
     """
 
-    if not get_track(media_info, 'Image'):
+    image = get_track(media_info, 'Image')
+    if not image:
         return None
 
     return [
-        get_track(media_info, 'Image').width,
-        get_track(media_info, 'Image').height
+        image.width,
+        image.height
     ]
 
 
+def get_cached_mediainfo(path, stat):
+    """
+
+    Returns the cached MediaInfo for path if the file hasn't changed
+    since it was parsed, otherwise None
+
+    """
+
+    if cache_size <= 0:
+        return None
+    try:
+        with store.open_db('mediainfo',cache_schema) as db:
+            row = db.execute('SELECT media_info FROM mediainfo WHERE path = ? AND size = ? AND mtime_ns = ?',(path,stat.st_size,stat.st_mtime_ns)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE mediainfo SET last_used = ? WHERE path = ?',(time.time(),path))
+    except sqlite3.Error as e:
+        logger.debug("Could not read mediainfo cache: %s" % str(e))
+        return None
+    logger.debug("Using cached mediainfo for %s" % path)
+    return media_info_from_json(row[0])
+
+
+def cache_mediainfo(path, stat, media_info):
+    if cache_size <= 0:
+        return
+    try:
+        with store.open_db('mediainfo',cache_schema) as db:
+            db.execute('INSERT OR REPLACE INTO mediainfo VALUES (?, ?, ?, ?, ?)',(path,stat.st_size,stat.st_mtime_ns,media_info.to_json(),time.time()))
+            db.execute('DELETE FROM mediainfo WHERE path IN (SELECT path FROM mediainfo ORDER BY last_used DESC LIMIT -1 OFFSET ?)',(cache_size,))
+    except sqlite3.Error as e:
+        logger.debug("Could not write mediainfo cache: %s" % str(e))
+
+
 def get_mediainfo(url):
     """
 
     Returns a MediaInfo object for a URL to be used
-    in other calls in this package
+    in other calls in this package.  Local files are
+    only parsed again if their size or mtime changed.
 
     """
 
-    media_info = MediaInfo.parse(url) #, mediainfo_options={"File_TestContinuousFileNames": "0"})
+    try:
+        path = os.path.realpath(url)
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+
+    if stat is not None:
+        media_info = get_cached_mediainfo(path,stat)
+        if media_info is not None:
+            return media_info
+
+    media_info = parse_mediainfo(url)
+    if stat is not None:
+        cache_mediainfo(path,stat,media_info)
     return media_info
 
-def get_lowres_video_info(full_path, start_time_code=None, is_drop_frame_value=None):
+def get_lowres_video_info(full_path, start_time_code=None, is_drop_frame_value=None, media_info=None):
     try:
         file_size = os.path.getsize(full_path)
     except FileNotFoundError:
@@ -115,14 +273,15 @@ def get_lowres_video_info(full_path, start_time_code=None, is_drop_frame_value=N
     if file_size == 0:
         raise MediaInfoException('Lowres file is empty')
 
-    try:
-        media_info = get_mediainfo(full_path)
-    except FileNotFoundError:
-        raise MediaInfoException('Lowres file not found/empty')
-    try:
-        general_track = next(track for track in media_info.tracks if track.track_type == 'General')
-        video_track = next(track for track in media_info.tracks if track.track_type == 'Video')
-    except StopIteration:
+    if media_info is None:
+        try:
+            media_info = get_mediainfo(full_path)
+        except FileNotFoundError:
+            raise MediaInfoException('Lowres file not found/empty')
+    index = get_track_index(media_info)
+    general_track = index.get('General')
+    video_track = index.get('Video')
+    if general_track is None or video_track is None:
         raise MediaInfoException('Lowres does not have the correct media tracks')
 
     result = {
@@ -164,14 +323,15 @@ def is_drop_frame(mediainfo_video_track):
 def get_proxy_metadata(full_path, start_time_code=None, is_drop_frame=None):
 
     media_info = get_mediainfo(full_path)
-    video = get_track(media_info, 'Video')
-    image = get_track(media_info, 'Image')
-    audio = get_track(media_info, 'Audio')
-    general = get_track(media_info, 'General')
+    index = get_track_index(media_info)
+    video = index.get('Video')
+    image = index.get('Image')
+    audio = index.get('Audio')
+    general = index.get('General')
 
     if video:
         logger.debug("Getting lowres mediainfo")
-        metadata = get_lowres_video_info(full_path, start_time_code, is_drop_frame)
+        metadata = get_lowres_video_info(full_path, start_time_code, is_drop_frame, index)
     elif audio:
         metadata = {
             'codec': audio.format or audio.codec_family or general.format or "",
@@ -209,17 +369,182 @@ def is_pdf_format(media_info):
     if not media_info:
         return False
 
-    general = get_track(media_info, "General")
-    text = get_track(media_info, "Text")
+    index = get_track_index(media_info)
+    general = index.get("General")
+    text = index.get("Text")
 
     return general and text and general.format == "PDF" and text.format == "PDF"
 
 
-def run_media_info(f, q, t):
-    try:
-        q.put(get_mediainfo(f), timeout=t)
-    except FileNotFoundError:
-        q.put(None)
+def run_media_info(conn):
+    """
+
+    Probe worker process loop.  Receives paths over conn
+    and sends back ('ok', json) or ('error', message)
+    until it is sent None.
+
+    """
+
+    #the parent handles ctrl-c and kills us if needed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        f = conn.recv()
+        if f is None:
+            break
+        try:
+            conn.send(('ok', MediaInfo.parse(f).to_json()))
+        except Exception as e:
+            conn.send(('error', "%s: %s" % (type(e).__name__, str(e))))
+
+
+class ProbeWorker(object):
+    """
+
+    One mediainfo process that can be killed and
+    replaced if a probe hangs
+
+    """
+
+    def __init__(self):
+        #fork rather than spawn, spawning would re-run the calling script's top level code
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_media_info, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def probe(self, f, timeout):
+        self.conn.send(f)
+        if not self.conn.poll(timeout):
+            raise MediaInfoTimeout("mediainfo timed out after %s seconds on %s" % (timeout, f))
+        status, result = self.conn.recv()
+        if status != 'ok':
+            raise MediaInfoException("mediainfo failed on %s: %s" % (f, result))
+        return media_info_from_json(result)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class ProbePool(object):
+    """
+
+    Reusable pool of mediainfo processes.  Workers are started
+    on demand up to size, and a worker that goes past the
+    per-file timeout is killed and replaced.
+
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.started = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.started >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return ProbeWorker()
+        except Exception:
+            self.discard()
+            raise
+
+    def release(self, worker):
+        with self.condition:
+            self.idle.append(worker)
+            self.condition.notify()
+
+    def discard(self):
+        with self.condition:
+            self.started -= 1
+            self.condition.notify()
+
+    def probe(self, f):
+        worker = self.acquire()
+        try:
+            media_info = worker.probe(f, self.timeout)
+        except MediaInfoTimeout as e:
+            logger.error("Killing hung mediainfo worker: %s" % str(e))
+            worker.kill()
+            self.discard()
+            raise
+        except MediaInfoException:
+            #the worker is fine, mediainfo just couldn't read this file
+            self.release(worker)
+            raise
+        except (EOFError, OSError) as e:
+            logger.error("mediainfo worker died: %s" % str(e))
+            worker.kill()
+            self.discard()
+            raise MediaInfoException("mediainfo worker died probing %s" % f)
+        self.release(worker)
+        return media_info
+
+    def close(self):
+        with self.condition:
+            workers, self.idle = self.idle, []
+            self.started -= len(workers)
+        for worker in workers:
+            worker.stop()
+
+
+def get_probe_pool():
+    global probe_pool
+    with probe_pool_lock:
+        if probe_pool is None:
+            probe_pool = ProbePool(probe_workers, probe_timeout)
+            atexit.register(probe_pool.close)
+        return probe_pool
+
+
+def parse_mediainfo(url):
+    """
+
+    Runs mediainfo on url, in the probe pool when a
+    timeout is configured
+
+    """
+
+    if probe_timeout > 0:
+        return get_probe_pool().probe(url)
+    return MediaInfo.parse(url) #, mediainfo_options={"File_TestContinuousFileNames": "0"})
+
+
+def get_mediainfo_many(urls):
+    """
+
+    Probes many files in parallel across the probe pool.
+    Returns a dict of url: MediaInfo, or the exception
+    raised for that url.
+
+    """
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, probe_workers)) as executor:
+        futures = {executor.submit(get_mediainfo, url): url for url in urls}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
 
 
 class MediaInfoTrack(Track):
@@ -232,6 +557,10 @@ class MediaInfoCustom(MediaInfo):
         self.xml_dom = None
         self._tracks = []
 
+    @property
+    def tracks(self):
+        return self._tracks
+
     def from_json(self, data):
         self._tracks = []
         for track in data.get('tracks', []):
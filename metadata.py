@@ -0,0 +1,304 @@
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+import requests
+
+import assetindex
+import iconik
+import metrics
+import store
+
+logger = logging.getLogger()
+
+metadata_map_file = os.path.join(iconik.base_dir,'config','metadata-map.json')
+
+#only send fields that changed since our last successful push
+incremental = True
+
+state_schema = '''
+CREATE TABLE IF NOT EXISTS pushed (
+    asset_id TEXT NOT NULL,
+    view_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (asset_id, view_id, field)
+);
+'''
+
+class MetadataException(Exception):
+    pass
+
+def configure(config):
+    """
+    Reads the optional [metadata] section of config.ini
+    """
+    global incremental
+    incremental = config.getboolean('metadata','incremental',fallback=incremental)
+
+#optional value transforms a metadata-map.json entry can ask for
+transforms = {
+    'strip':lambda value: value.strip(),
+    'lower':lambda value: value.lower(),
+    'upper':lambda value: value.upper(),
+    'title':lambda value: value.title(),
+    'boolean':lambda value: 'true' if value.strip().lower() in ('true','yes','1','on') else 'false',
+}
+
+class FieldMapper(object):
+    """
+    metadata-map.json compiled into a dict keyed on CatDV field, so each
+    xml tag is mapped with one lookup.  Entries may also set "split" to a
+    separator for multi-value fields and "transform" to one of the
+    transforms above, for example:
+
+        {"iconik_field_id":"Keywords","catdv_field_id":"USER6","split":",","transform":"strip"}
+    """
+    def __init__(self, metadata_map):
+        self.fields = {}
+        for item in metadata_map['field_map']:
+            transform = item.get('transform')
+            if transform is not None and transform not in transforms:
+                raise MetadataException('Unknown transform ' + transform + ' for field ' + item['catdv_field_id'])
+            logger.debug('Found field ' + item['catdv_field_id'])
+            self.fields.setdefault(item['catdv_field_id'],[]).append((item['iconik_field_id'],item.get('split'),transforms.get(transform)))
+
+    def map_value(self, tag, text):
+        """
+        Returns a list of (iconik field, [values]) for one CatDV field
+        """
+        mapped = []
+        for iconik_field, split, transform in self.fields.get(tag,()):
+            values = text.split(split) if split and text is not None else [text]
+            if transform is not None:
+                values = [transform(value) for value in values if value is not None]
+            if split:
+                values = [value for value in values if value]
+            mapped.append((iconik_field,values))
+        return mapped
+
+    #map the fields of one clip into a new dict
+    def map_clip(self, clip):
+        iconik_metadata = {}
+        for tags in clip:
+            if tags.tag in self.fields:
+                logger.debug('Found field ' + tags.tag + '. Contains value ' + str(tags.text))
+                for iconik_field, values in self.map_value(tags.tag,tags.text):
+                    iconik_metadata[iconik_field] = values
+        return iconik_metadata
+
+#load our metadata map
+def load_metadata_map(path=metadata_map_file):
+    logger.debug('Reading metadata map')
+    try:
+        logger.debug('Attempting to read file ' + path)
+        with open(path,'r') as json_file:
+            return FieldMapper(json.load(json_file))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.debug(str(e))
+        raise MetadataException('Could not parse metadata map')
+
+#stream the clips out of a CatDV xml export, clearing each one once we're done with it
+def iter_clips(xml_file):
+    logger.info('Opening CatDV XML ' + xml_file)
+    root = None
+    depth = 0
+    try:
+        for event, elem in ET.iterparse(xml_file,events=('start','end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield elem
+                root.clear()
+    except (OSError, ET.ParseError) as e:
+        logger.debug(str(e))
+        raise MetadataException('Could not parse CatDV XML file ' + xml_file)
+
+#parse the xml, map the fields, build a new dict
+def get_catdv_metadata(xml_file, metadata_map):
+    iconik_metadata = {}
+    logger.debug('Looping through mapped CatDV fields and getting values')
+    for clip in iter_clips(xml_file):
+        iconik_metadata.update(metadata_map.map_clip(clip))
+    return iconik_metadata
+
+#CatDV user fields are U2 in the Worker Node but USER2 in the xml
+def get_catdv_tag(field):
+    if field[:1] == 'U' and field[1:].isdigit():
+        return 'USER' + field[1:]
+    return field
+
+def export_updates(xml_file, metadata_map, iconik_id_tag, clip_id_tag, catdv_id_field, errors):
+    """
+    Streams a multi-clip CatDV xml export and yields (iconik ID, payload)
+    for every clip that has an iconik ID in iconik_id_tag.  Clips that
+    haven't been synced yet are skipped, a broken export is appended to
+    errors as (xml file, error).  Each clip's iconik ID is recorded in the
+    asset index.
+    """
+    linker = assetindex.Linker()
+    try:
+        for clip in iter_clips(xml_file):
+            iconik_id = (clip.findtext(iconik_id_tag) or '').strip()
+            if not iconik_id:
+                logger.debug('Skipping clip ' + str(clip.findtext(clip_id_tag)) + ' with no iconik ID')
+                continue
+            linker.add(iconik_id,clip.findtext(clip_id_tag))
+            yield iconik_id, build_metadata_payload(metadata_map.map_clip(clip),catdv_id_field,clip.findtext(clip_id_tag))
+    except MetadataException as e:
+        errors.append((xml_file,str(e)))
+    finally:
+        linker.flush()
+
+#create iconik metadata json
+def build_metadata_payload(iconik_metadata, catdv_id_field=None, catdvid=None):
+    iconik_post_data = {
+        'metadata_values':{}
+    }
+    for field,values in iconik_metadata.items():
+        if not isinstance(values,list):
+            values = [values]
+        iconik_post_data['metadata_values'][field] = {'field_values':[{"value":value} for value in values]}
+
+    if catdv_id_field is not None:
+        iconik_post_data['metadata_values'][catdv_id_field] = {'field_values':[{"value":catdvid}]}
+    return iconik_post_data
+
+def hash_field(value):
+    return hashlib.sha1(json.dumps(value,sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_changes(iconik_id, view_id, iconik_post_data):
+    """
+    Returns a payload with only the fields whose value differs from what
+    we last pushed to this asset and view, or None if nothing changed
+    """
+    if not incremental:
+        return iconik_post_data
+    with store.open_db('metadata',state_schema) as db:
+        pushed = dict(db.execute('SELECT field, hash FROM pushed WHERE asset_id = ? AND view_id = ?',(iconik_id,view_id)).fetchall())
+    changed = {field:value for field,value in iconik_post_data['metadata_values'].items() if pushed.get(field) != hash_field(value)}
+    if not changed:
+        return None
+    return dict(iconik_post_data,metadata_values=changed)
+
+#remember what we pushed so the next run can skip unchanged fields
+def record_push(iconik_id, view_id, iconik_post_data):
+    if not incremental:
+        return
+    now = time.time()
+    with store.open_db('metadata',state_schema) as db:
+        db.executemany('INSERT OR REPLACE INTO pushed VALUES (?, ?, ?, ?, ?)',[(iconik_id,view_id,field,hash_field(value),now) for field,value in iconik_post_data['metadata_values'].items()])
+
+#post data to iconik
+def update_metadata(url, headers, iconik_id, view_id, iconik_post_data):
+    """
+    PUTs the fields that changed since our last push, returns the
+    response or None if there was nothing to send
+    """
+    changes = get_changes(iconik_id,view_id,iconik_post_data)
+    if changes is None:
+        logger.info('Metadata for iconik asset ' + iconik_id + ' is unchanged, skipping update')
+        return None
+    iconik_post_data = changes
+    logger.debug(json.dumps(iconik_post_data,indent=4,sort_keys=True))
+    try:
+        logger.info('Updating metadata for iconik asset ' + iconik_id)
+        with metrics.span('metadata_put',asset_id=iconik_id,fields=len(iconik_post_data['metadata_values'])) as fields:
+            r = iconik.put_metadata(url,headers,iconik_id,view_id,iconik_post_data)
+            if r.status_code >= 400:
+                fields['outcome'] = 'error'
+        logger.debug('Respose text:\n' + r.text)
+        logger.info('Made call: ' + url + 'API/metadata/v1/assets/' + iconik_id + '/assets/' + iconik_id + '/views/' + view_id + '/')
+        logger.info('Response Status Code: ' + str(r.status_code))
+    except requests.exceptions.RequestException as e:
+        logger.debug(str(e))
+        raise MetadataException('Error updating metadata in iconik for asset ' + iconik_id)
+    if r.status_code >= 400:
+        try:
+            logger.error(r.json()['errors'])
+        except (ValueError, KeyError):
+            pass
+        raise MetadataException('Error updating metadata in iconik for asset ' + iconik_id)
+    record_push(iconik_id,view_id,iconik_post_data)
+    return r
+
+#run the full xml to iconik update for one asset
+def sync_xml(xml_file, metadata_map, url, headers, iconik_id, view_id, catdv_id_field=None, catdvid=None):
+    iconik_metadata = get_catdv_metadata(xml_file,metadata_map)
+    iconik_post_data = build_metadata_payload(iconik_metadata,catdv_id_field,catdvid)
+    r = update_metadata(url,headers,iconik_id,view_id,iconik_post_data)
+    if catdvid is not None:
+        assetindex.link(iconik_id,catdvid)
+    return r
+
+#read a resync manifest, one "iconik ID,CatDV ID,xml path" row per asset
+def read_manifest(manifest):
+    with open(manifest,'r',newline='') as f:
+        return [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+def manifest_updates(rows, metadata_map, catdv_id_field, errors):
+    """
+    Yields (iconik ID, payload) for each manifest row, appending
+    (iconik ID, error) to errors for rows whose xml can't be read.  Each
+    row's IDs are recorded in the asset index.
+    """
+    linker = assetindex.Linker()
+    try:
+        for row in rows:
+            try:
+                iconik_id, catdvid, xml_file = row
+            except ValueError:
+                errors.append((','.join(row),'Manifest row should be iconik ID,CatDV ID,xml path'))
+                continue
+            linker.add(iconik_id,catdvid)
+            try:
+                iconik_metadata = get_catdv_metadata(xml_file,metadata_map)
+            except MetadataException as e:
+                errors.append((iconik_id,str(e)))
+                continue
+            yield iconik_id, build_metadata_payload(iconik_metadata,catdv_id_field,catdvid)
+    finally:
+        linker.flush()
+
+async def push_worker(client, view_id, updates, results):
+    for iconik_id, iconik_post_data in updates:
+        changes = get_changes(iconik_id,view_id,iconik_post_data)
+        if changes is None:
+            logger.debug('Metadata for iconik asset ' + iconik_id + ' is unchanged, skipping update')
+            results.append((iconik_id,None))
+            continue
+        try:
+            with metrics.span('metadata_put',asset_id=iconik_id,fields=len(changes['metadata_values'])):
+                await client.put_metadata(iconik_id,view_id,changes)
+            record_push(iconik_id,view_id,changes)
+            logger.info('Updated metadata for iconik asset ' + iconik_id)
+            results.append((iconik_id,None))
+        except iconik.IconikException as e:
+            logger.error('Error updating metadata in iconik for asset ' + iconik_id + ': ' + str(e))
+            results.append((iconik_id,str(e)))
+
+async def push_all(url, headers, view_id, updates, concurrency):
+    #aiohttp is slow to import, only load it when we push in bulk
+    import aioiconik
+    results = []
+    updates = iter(updates)
+    async with aioiconik.Client(url,headers,concurrency) as client:
+        #every worker pulls from the same iterator so only `concurrency` payloads are in memory
+        await asyncio.gather(*[push_worker(client,view_id,updates,results) for i in range(concurrency)])
+    return results
+
+def push_metadata(url, headers, view_id, updates, concurrency=50):
+    """
+    PUTs many (iconik ID, payload) updates at once from a single event
+    loop and returns a list of (iconik ID, error) with error None on success
+    """
+    return asyncio.run(push_all(url,headers,view_id,updates,concurrency))
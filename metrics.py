@@ -0,0 +1,153 @@
+import atexit
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+import store
+
+logger = logging.getLogger()
+
+#spans go to their own logger so they can be written as plain JSON lines
+span_logger = logging.getLogger('spans')
+
+#settings from the [metrics] section of config.ini
+span_log = True
+textfile_dir = None
+
+#upper bounds in seconds, from a quick PATCH up to a large upload
+buckets = (0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0,30.0,60.0,120.0,300.0,600.0,1800.0)
+
+#metric families we export: type and help text
+families = {
+    'iconik_sync_stage_seconds':('histogram','Time spent in each stage of a sync job'),
+    'iconik_sync_stage_total':('counter','Sync job stages run, by outcome'),
+    'iconik_sync_upload_bytes_total':('counter','Proxy bytes uploaded to storage'),
+}
+
+#(metric name, label string): value, histogram buckets are kept cumulative
+samples = {}
+samples_lock = threading.Lock()
+
+schema = '''
+CREATE TABLE IF NOT EXISTS totals (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+'''
+
+def configure(config, log_dir=None, textfile=True):
+    """
+    Reads the optional [metrics] section of config.ini.  Spans are written
+    as JSON lines to log_dir/spans.log, and if textfile is True and a
+    textfile-dir is set, totals are written there for the Prometheus node
+    exporter when the script exits.
+    """
+    global span_log, textfile_dir
+    span_log = config.getboolean('metrics','span-log',fallback=span_log)
+    textfile_dir = config.get('metrics','textfile-dir',fallback=None) or None
+    span_logger.propagate = False
+    if span_log and log_dir is not None and not span_logger.handlers:
+        handler = logging.handlers.RotatingFileHandler(os.path.join(log_dir,'spans.log'),maxBytes=104857600,backupCount=5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        span_logger.addHandler(handler)
+        span_logger.setLevel(logging.INFO)
+    if textfile and textfile_dir is not None:
+        atexit.register(write_textfile)
+
+def add(name, labels, value):
+    key = (name,labels)
+    samples[key] = samples.get(key,0) + value
+
+def observe(stage, seconds, outcome, size=None):
+    label = 'stage="' + stage + '"'
+    with samples_lock:
+        for bound in buckets:
+            if seconds <= bound:
+                add('iconik_sync_stage_seconds_bucket',label + ',le="' + str(bound) + '"',1)
+        add('iconik_sync_stage_seconds_bucket',label + ',le="+Inf"',1)
+        add('iconik_sync_stage_seconds_sum',label,seconds)
+        add('iconik_sync_stage_seconds_count',label,1)
+        add('iconik_sync_stage_total',label + ',outcome="' + outcome + '"',1)
+        if size and outcome == 'ok':
+            add('iconik_sync_upload_bytes_total','',size)
+
+@contextlib.contextmanager
+def span(stage, **fields):
+    """
+    Times the block as one stage of a sync job.  The yielded dict can be
+    given more fields for the span, 'bytes' also adds a throughput.  The
+    span is logged as JSON and counted in the stage histogram, with
+    outcome 'error' if the block raised or set fields['outcome'].
+
+        with metrics.span('upload',path=path,bytes=size):
+            upload.upload_file(session_url,path)
+    """
+    start = time.monotonic()
+    outcome = 'ok'
+    try:
+        yield fields
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        seconds = time.monotonic() - start
+        outcome = fields.pop('outcome',outcome)
+        observe(stage,seconds,outcome,fields.get('bytes') if stage == 'upload' else None)
+        if span_logger.isEnabledFor(logging.INFO):
+            record = {'time':time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime()),'stage':stage,'seconds':round(seconds,4),'outcome':outcome,'thread':threading.current_thread().name}
+            record.update(fields)
+            if fields.get('bytes') and seconds > 0:
+                record['bytes_per_sec'] = round(fields['bytes'] / seconds)
+            span_logger.info(json.dumps(record,default=str))
+
+def render(totals=None):
+    """
+    Returns totals (or this process's samples) in the Prometheus text format
+    """
+    if totals is None:
+        with samples_lock:
+            totals = dict(samples)
+    lines = []
+    for family, (kind, description) in families.items():
+        lines.append('# HELP ' + family + ' ' + description)
+        lines.append('# TYPE ' + family + ' ' + kind)
+        #le sorts as text otherwise, so order buckets by their bound
+        keys = sorted([key for key in totals if key[0] == family or (kind == 'histogram' and key[0].rsplit('_',1)[0] == family)],key=sort_key)
+        for name, labels in keys:
+            lines.append(name + ('{' + labels + '}' if labels else '') + ' ' + format_value(totals[(name,labels)]))
+    return '\n'.join(lines) + '\n'
+
+def sort_key(key):
+    name, labels = key
+    bound = labels.rpartition('le="')[2].rstrip('"') if 'le="' in labels else ''
+    return (name,labels.rpartition(',le=')[0] if bound else labels,float(bound) if bound else 0)
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def write_textfile():
+    """
+    Adds this process's samples to the running totals in the state folder
+    and rewrites textfile-dir/iconik_sync.prom from them, so the totals
+    cover every one-shot run
+    """
+    with samples_lock:
+        pending = dict(samples)
+        samples.clear()
+    try:
+        with store.open_db('metrics',schema) as db:
+            db.executemany('INSERT INTO totals VALUES (?, ?, ?) ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',[(name,labels,value) for (name,labels),value in pending.items()])
+            totals = {(name,labels):value for name,labels,value in db.execute('SELECT name, labels, value FROM totals').fetchall()}
+        path = os.path.join(textfile_dir,'iconik_sync.prom')
+        #write then rename so the exporter never reads half a file
+        with open(path + '.' + str(os.getpid()),'w') as f:
+            f.write(render(totals))
+        os.replace(path + '.' + str(os.getpid()),path)
+    except OSError as e:
+        logger.error('Could not write metrics to ' + str(textfile_dir) + ': ' + str(e))
@@ -0,0 +1,682 @@
+import concurrent.futures
+import logging
+import mimetypes
+import os
+import queue
+import threading
+import time
+import requests
+
+import assetindex
+import checksum
+import iconik
+import mediainfo
+import metrics
+import staging
+import transcode
+import upload
+
+logger = logging.getLogger()
+
+#keys from mediainfo.get_proxy_metadata that iconik accepts on a proxy object
+proxy_metadata_keys = ['bit_rate','codec','format','frame_rate','is_drop_frame','resolution','start_time_code']
+
+#originals are hashed in the background while their proxy uploads
+hash_workers = 4
+hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers,thread_name_prefix='checksum')
+#a single proxy is probed while its asset is being created
+probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4,thread_name_prefix='probe')
+
+class ProxyException(Exception):
+    pass
+
+#parse out only the filename, strip path and extension
+def get_filename_for_title(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+#delete a half created asset (and proxy) after a failure
+def cleanup(url, headers, new_id, proxy_id=None):
+    try:
+        if proxy_id is not None:
+            logger.error('Deleting empty proxy ' + proxy_id)
+            iconik.delete_proxy(url,headers,new_id,proxy_id)
+        logger.error('Deleting empty asset ' + new_id)
+        iconik.delete_asset(url,headers,new_id)
+        assetindex.forget(new_id)
+    except requests.exceptions.RequestException as e:
+        logger.error('Could not clean up asset ' + new_id + ': ' + str(e))
+
+#delete a proxy we couldn't upload to, leaving its asset alone
+def delete_proxy(url, headers, asset_id, proxy_id):
+    try:
+        logger.error('Deleting empty proxy ' + proxy_id)
+        iconik.delete_proxy(url,headers,asset_id,proxy_id)
+    except requests.exceptions.RequestException as e:
+        logger.error('Could not clean up proxy ' + proxy_id + ': ' + str(e))
+
+#read the proxy fields iconik wants from mediainfo
+def probe_proxy(path):
+    try:
+        mediainfo.check_installed()
+    except mediainfo.MediaInfoException as e:
+        raise ProxyException(str(e))
+    try:
+        with metrics.span('probe',path=path):
+            return mediainfo.get_proxy_metadata(staging.local(path))
+    except Exception as e:
+        logger.debug(str(e))
+        raise ProxyException('Could not read media info for ' + path)
+
+#render the proxy from the original when CatDV hasn't
+def ensure_proxy(path, source):
+    if source is None or not transcode.enabled or os.path.isfile(path):
+        return
+    try:
+        transcode.make_proxy(source,path)
+    except transcode.TranscodeException as e:
+        raise ProxyException(str(e))
+
+#create the asset and proxy objects and open a resumable upload session
+def start_proxy(path, url, headers, media_info=None):
+    """
+    Creates an iconik asset and an AWAITED proxy for path and returns
+    (asset ID, proxy ID, upload session URL).  media_info is the result
+    of probe_proxy, or a Future of it so probing overlaps the asset POST;
+    if None the probe is started here.  Raises ProxyException on failure
+    after cleaning up anything it created.
+    """
+    if media_info is None:
+        media_info = probe_pool.submit(probe_proxy,path)
+    #try creating our placeholder
+    data = {
+        "analyze_status": "N/A",
+        "archive_status": "NOT_ARCHIVED",
+        "is_online": "false",
+        "status": "ACTIVE",
+        "title": get_filename_for_title(path),
+        "type": "ASSET"
+    }
+    try:
+        with metrics.span('asset_create',path=path) as fields:
+            r = iconik.create_asset(url,headers,data)
+            logger.debug(r.text)
+            new_id = fields['asset_id'] = r.json()['id']
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.debug(str(e))
+        raise ProxyException('Could not create asset in iconik')
+
+    #try creating a proxy
+    if isinstance(media_info,concurrent.futures.Future):
+        try:
+            media_info = media_info.result()
+        except ProxyException:
+            cleanup(url,headers,new_id)
+            raise
+    try:
+        proxy_id, session_url = open_proxy(path,url,headers,new_id,media_info)
+    except ProxyException:
+        cleanup(url,headers,new_id)
+        raise
+    return new_id, proxy_id, session_url
+
+#add an AWAITED proxy to an asset and open a resumable upload session for it
+def open_proxy(path, url, headers, asset_id, media_info):
+    """
+    Returns (proxy ID, upload session URL).  Raises ProxyException on
+    failure after deleting the proxy if it got that far, the asset is
+    left to the caller.
+    """
+    data = {key:media_info[key] for key in proxy_metadata_keys if key in media_info}
+    data["asset_id"] = asset_id
+    data["filename"] = os.path.basename(path)
+    data["name"] = os.path.basename(path)
+    data["status"] = "AWAITED"
+    data["storage_id"] = None
+    try:
+        with metrics.span('proxy_create',path=path,asset_id=asset_id):
+            r = iconik.create_proxy(url,headers,asset_id,data)
+            logger.debug(r.text)
+            proxy = r.json()
+            proxy_id = proxy['id']
+        logger.info('Creating new proxy object ' + proxy_id)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.debug(str(e))
+        raise ProxyException('Could not create proxy in iconik')
+
+    #check if we got our resumable URL
+    if 'upload_url' not in proxy:
+        delete_proxy(url,headers,asset_id,proxy_id)
+        raise ProxyException('Could not get upload URL')
+    logger.info('Getting resumable upload URL')
+    try:
+        with metrics.span('upload_url',path=path,asset_id=asset_id) as fields:
+            g = iconik.start_resumable_upload(proxy['upload_url'])
+            if 'location' not in g.headers:
+                fields['outcome'] = 'error'
+    except requests.exceptions.RequestException as e:
+        logger.debug(str(e))
+        g = None
+    #check if we got our target URL
+    if g is None or 'location' not in g.headers:
+        delete_proxy(url,headers,asset_id,proxy_id)
+        raise ProxyException('Could not get upload URL')
+    logger.info('Successfully got upload URL')
+    logger.debug(g.headers)
+    return proxy_id, g.headers['location']
+
+#close the proxy, mark the asset complete and kick off keyframes
+def finish_proxy(path, url, headers, new_id, proxy_id, keep_asset=False):
+    """
+    Raises ProxyException on failure after deleting the asset, unless
+    keep_asset is set because the asset was there before us
+    """
+    try:
+        with metrics.span('finalize',path=path,asset_id=new_id):
+            logger.info('Setting proxy ' + proxy_id + ' to CLOSED')
+            r = iconik.update_proxy(url,headers,new_id,proxy_id,{"status":"CLOSED"})
+            logger.debug(r.text)
+            logger.info('Setting asset completion for ' + new_id)
+            r = iconik.update_asset(url,headers,new_id,{"type":"ASSET"})
+            logger.debug(r.text)
+        with metrics.span('keyframes',path=path,asset_id=new_id):
+            logger.info('Generating keyframes for asset ' + new_id)
+            r = iconik.create_keyframes(url,headers,new_id,proxy_id)
+            logger.debug(r.text)
+    except requests.exceptions.RequestException as e:
+        logger.debug(str(e))
+        if keep_asset:
+            delete_proxy(url,headers,new_id,proxy_id)
+        else:
+            cleanup(url,headers,new_id)
+        raise ProxyException('Error finalizing asset ' + new_id)
+    assetindex.record(new_id,'ok',proxy_id,os.path.realpath(path))
+    try:
+        assetindex.remember_fingerprint(checksum.get_fingerprint(staging.local(path)),new_id)
+    except (OSError, checksum.ChecksumException) as e:
+        logger.debug('Could not fingerprint ' + path + ': ' + str(e))
+    logger.info('New asset ' + new_id + ' created with proxy from ' + path)
+
+#ask iconik whether an asset is still there, forgetting it if it isn't
+def asset_exists(url, headers, asset_id):
+    """
+    Returns True if iconik has asset_id, False if it is deleted or gone,
+    and None if iconik couldn't be asked
+    """
+    try:
+        r = iconik.get_asset(url,headers,asset_id)
+        asset = r.json() if r.status_code < 400 else {}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.debug(str(e))
+        return None
+    if r.status_code == 404 or (r.status_code < 400 and asset.get('status','ACTIVE') != 'ACTIVE'):
+        assetindex.forget(asset_id)
+        return False
+    if r.status_code >= 400:
+        return None
+    return True
+
+#check that a finished upload still stands before handing its asset out again
+def is_current(path, url, headers, asset_id):
+    """
+    Returns False if asset_id is gone from iconik, or the proxy at path
+    has changed since it was uploaded there, so the upload should run
+    again.  When in doubt it returns True, like a finished job always did.
+    """
+    entry = assetindex.get_entry(asset_id)
+    if entry is not None and entry['status'] == 'deleted':
+        return False
+    if asset_exists(url,headers,asset_id) is False:
+        logger.info('Asset ' + asset_id + ' is gone from iconik, uploading ' + path + ' again')
+        return False
+    fingerprints = assetindex.get_fingerprints(asset_id)
+    if fingerprints and os.path.isfile(path):
+        try:
+            fingerprint = checksum.get_fingerprint(staging.local(path))
+        except (OSError, checksum.ChecksumException) as e:
+            logger.debug('Could not fingerprint ' + path + ': ' + str(e))
+            return True
+        if fingerprint not in fingerprints:
+            logger.info('Proxy ' + path + ' has changed since it was uploaded to asset ' + asset_id + ', uploading it again')
+            return False
+    return True
+
+#look for an asset we already uploaded this exact content to
+def find_uploaded(path, url, headers, catdv_id=None):
+    """
+    Returns the ID of a live asset we already uploaded a proxy with the
+    same fingerprint to, or None.  An asset that belongs to a different
+    CatDV clip doesn't count, and iconik is asked whether the asset is
+    still there before we trust it.
+    """
+    if not upload.dedup:
+        return None
+    with metrics.span('dedup',path=path) as fields:
+        fields['outcome'] = 'miss'
+        try:
+            fingerprint = checksum.get_fingerprint(staging.local(path))
+        except (OSError, checksum.ChecksumException) as e:
+            logger.debug('Could not fingerprint ' + path + ': ' + str(e))
+            return None
+        entry = assetindex.find_fingerprint(fingerprint,catdv_id)
+        if entry is None:
+            return None
+        exists = asset_exists(url,headers,entry['asset_id'])
+        if exists is False:
+            logger.info('Asset ' + entry['asset_id'] + ' with the same proxy is gone from iconik, uploading ' + path + ' again')
+        if not exists:
+            return None
+        fields['outcome'] = 'hit'
+        fields['asset_id'] = entry['asset_id']
+    logger.info('Proxy ' + path + ' was already uploaded to asset ' + entry['asset_id'] + ', skipping upload')
+    if catdv_id is not None:
+        assetindex.link(entry['asset_id'],catdv_id)
+    return entry['asset_id']
+
+#look for an unfinished upload of this exact file from an earlier run
+def resume_proxy(path, url, headers):
+    session = upload.get_session(path)
+    if session is None:
+        return None
+    new_id, proxy_id, session_url = session
+    try:
+        offset = upload.query_offset(session_url,os.path.getsize(path))
+    except upload.SessionExpired:
+        logger.info('Upload session for ' + path + ' has expired, starting over')
+        cleanup(url,headers,new_id,proxy_id)
+        upload.clear_session(path)
+        return None
+    except (requests.exceptions.RequestException, upload.UploadException) as e:
+        logger.debug(str(e))
+        offset = 0
+    if offset is not None:
+        logger.info('Resuming upload of ' + path + ' to asset ' + new_id + ' from byte ' + str(offset))
+    return new_id, proxy_id, session_url, offset
+
+#reuse an unfinished upload of path or start a new one
+def prepare_upload(path, url, headers, media_info=None, catdv_id=None):
+    """
+    Returns (asset ID, proxy ID, upload session URL, offset to upload
+    from) for path, resuming an earlier run's upload when there is one.
+    New assets go in the asset index under catdv_id.
+    """
+    resumed = resume_proxy(path,url,headers)
+    if resumed is not None:
+        if catdv_id is not None:
+            assetindex.link(resumed[0],catdv_id)
+        return resumed
+    new_id, proxy_id, session_url = start_proxy(path,url,headers,media_info)
+    assetindex.record(new_id,'uploading',proxy_id,os.path.realpath(path),catdv_id)
+    upload.save_session(path,new_id,proxy_id,session_url)
+    return new_id, proxy_id, session_url, 0
+
+#upload our file
+def send_proxy(path, url, headers, new_id, proxy_id, session_url, offset=0):
+    #GCS already has every byte of a resumed session, only the finalize is left
+    if offset is None:
+        logger.info('Upload of ' + path + ' to asset ' + new_id + ' already completed')
+        upload.clear_session(path)
+        return
+    try:
+        logger.info('Starting upload of ' + path)
+        with metrics.span('upload',path=path,asset_id=new_id,bytes=os.path.getsize(path) - offset,offset=offset):
+            upload.upload_file(session_url,staging.local(path),offset)
+    except upload.SessionExpired as e:
+        logger.error('Upload failed!')
+        #the session is gone so nothing can be resumed, kill what we've done
+        cleanup(url,headers,new_id,proxy_id)
+        upload.clear_session(path)
+        raise ProxyException('Upload of ' + path + ' failed: ' + str(e))
+    except (OSError, upload.UploadException) as e:
+        #leave the asset and session in place so the next run can resume
+        logger.error('Upload failed, it will resume on the next run: ' + str(e))
+        raise ProxyException('Upload of ' + path + ' failed: ' + str(e))
+    logger.info('Upload completed successfully')
+    upload.clear_session(path)
+
+#create the full proxy with only path as an input
+def create_proxy(path, url, headers, original=None, storage_id=None, storage_root=None, catdv_id=None, source=None):
+    """
+    Creates an iconik asset, uploads the proxy at path to it and returns
+    the new asset ID.  Interrupted uploads are resumed from the last
+    committed byte on the next run.  If original and storage_id are given
+    the original is hashed while the proxy uploads and then linked to the
+    asset.  catdv_id is the clip the asset is recorded against in the
+    asset index.  If there is no proxy at path it is made from source
+    when transcoding is on.  Raises ProxyException on failure.
+    """
+    ensure_proxy(path,source)
+    if not os.path.isfile(path):
+        raise ProxyException('File ' + path + ' does not exist')
+    #one sequential read off the NAS, then probe, hash and upload read the local copy, pinned until the upload is done with it
+    staging.stage(path,pin=True)
+    try:
+        #a retried job whose upload already finished gets its asset back
+        if upload.get_session(path) is None:
+            existing = find_uploaded(path,url,headers,catdv_id)
+            if existing is not None:
+                return existing
+        link = original is not None and storage_id is not None
+        if link:
+            if not os.path.isfile(original):
+                raise ProxyException('Original ' + original + ' does not exist')
+            md5_hash = start_checksum(original)
+
+        try:
+            new_id, proxy_id, session_url, offset = prepare_upload(path,url,headers,catdv_id=catdv_id)
+            send_proxy(path,url,headers,new_id,proxy_id,session_url,offset)
+            finish_proxy(path,url,headers,new_id,proxy_id)
+        except BaseException:
+            #the executor is joined at exit, an unstopped hash would keep a failed run alive until the whole original is read
+            if link:
+                stop_checksum(md5_hash)
+            raise
+    finally:
+        staging.release(path)
+
+    #the proxy is in place, a failed link shouldn't throw the asset away
+    if link:
+        try:
+            link_isg(original,url,headers,new_id,storage_id,storage_root,finish_checksum(original,md5_hash))
+        except (OSError, ProxyException) as e:
+            logger.error(str(e))
+    return new_id
+
+#upload a new proxy to an asset that lost its own
+def repair_proxy(path, url, headers, asset_id):
+    """
+    Adds the proxy at path to an existing asset and returns the new proxy
+    ID.  The asset is never deleted, only the new proxy if the upload
+    fails.  Raises ProxyException on failure.
+    """
+    if not os.path.isfile(path):
+        raise ProxyException('File ' + path + ' does not exist')
+    staging.stage(path,pin=True)
+    try:
+        proxy_id, session_url = open_proxy(path,url,headers,asset_id,probe_proxy(path))
+        try:
+            logger.info('Starting upload of ' + path + ' to existing asset ' + asset_id)
+            with metrics.span('upload',path=path,asset_id=asset_id,bytes=os.path.getsize(path)):
+                upload.upload_file(session_url,staging.local(path))
+        except (OSError, upload.UploadException) as e:
+            delete_proxy(url,headers,asset_id,proxy_id)
+            raise ProxyException('Upload of ' + path + ' failed: ' + str(e))
+        finish_proxy(path,url,headers,asset_id,proxy_id,keep_asset=True)
+    finally:
+        staging.release(path)
+    return proxy_id
+
+#link our high res file
+def link_isg(path, url, headers, asset_id, storage_id, storage_root, md5=None):
+    """
+    Registers the original at path as the ORIGINAL format of asset_id on
+    an iconik storage.  path must live under storage_root, the local
+    mount point of that storage.
+    """
+    relative = os.path.relpath(os.path.dirname(os.path.realpath(path)),os.path.realpath(storage_root))
+    if relative.startswith('..'):
+        raise ProxyException('Original ' + path + ' is not inside iconik storage root ' + storage_root)
+    if relative == '.':
+        relative = ''
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    try:
+        logger.info('Creating ORIGINAL format for asset ' + asset_id)
+        r = iconik.create_format(url,headers,asset_id,{
+            "name": "ORIGINAL",
+            "metadata": [{"internet_media_type": mimetypes.guess_type(path)[0] or "application/octet-stream"}],
+            "storage_methods": ["FILE"]
+        })
+        logger.debug(r.text)
+        format_id = r.json()['id']
+        logger.info('Creating file set for ' + path)
+        r = iconik.create_file_set(url,headers,asset_id,{
+            "format_id": format_id,
+            "storage_id": storage_id,
+            "base_dir": relative,
+            "name": name,
+            "component_ids": []
+        })
+        logger.debug(r.text)
+        file_set_id = r.json()['id']
+        data = {
+            "original_name": name,
+            "name": name,
+            "directory_path": relative,
+            "size": stat.st_size,
+            "type": "FILE",
+            "status": "CLOSED",
+            "storage_id": storage_id,
+            "file_set_id": file_set_id,
+            "format_id": format_id,
+            "file_date_created": time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(stat.st_ctime)),
+            "file_date_modified": time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(stat.st_mtime))
+        }
+        if md5 is not None:
+            data["checksum"] = md5
+        logger.info('Registering original ' + path + ' on storage ' + storage_id)
+        r = iconik.create_file(url,headers,asset_id,data)
+        logger.debug(r.text)
+        return r.json()['id']
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        logger.debug(str(e))
+        raise ProxyException('Could not link original ' + path + ' to asset ' + asset_id)
+
+#hash the original on the side so it doesn't add to the upload time
+def start_checksum(path):
+    """
+    Starts hashing path in hash_pool and returns (future, stop event)
+    for finish_checksum or stop_checksum
+    """
+    logger.info("Attempting to generate checksum for " + path)
+    stop = threading.Event()
+    return hash_pool.submit(checksum.get_checksum,path,'md5',stop), stop
+
+def stop_checksum(started):
+    future, stop = started
+    future.cancel()
+    stop.set()
+
+def finish_checksum(path, started):
+    future, stop = started
+    try:
+        md5 = future.result()
+        logger.info("Checksum for " + path + " is " + md5)
+        return md5
+    except (OSError, checksum.ChecksumException) as e:
+        logger.debug(str(e))
+        logger.error("Could not generate checksum for " + path)
+        return None
+
+#lines the Worker Node parses back into CatDV fields
+def worker_output(new_id, iconik_id_field, iconik_url_field):
+    return [
+        "@" + iconik_id_field + "=" + new_id,
+        "@" + iconik_url_field + "=<a href=\"" + iconik.get_asset_url(new_id) + "\" target=\"_new\">iconik link</a>",
+    ]
+
+#read a batch manifest, one proxy path per line, skipping blanks and comments
+def read_manifest(manifest):
+    """
+    Returns the proxy paths in a manifest.  A line may add tab separated
+    columns for the original to make the proxy from and the CatDV ID of
+    the clip, either may be left empty.  Those lines come back as
+    (proxy, original, CatDV ID) with None for empty columns.
+    """
+    paths = []
+    with open(manifest,'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                if '\t' in line:
+                    columns = [column.strip() or None for column in line.split('\t')] + [None,None]
+                    paths.append(tuple(columns[:3]))
+                else:
+                    paths.append(line)
+    return paths
+
+#list the proxies in a directory, skipping hidden files and subfolders
+def list_directory(directory):
+    return [os.path.join(directory,name) for name in sorted(os.listdir(directory)) if not name.startswith('.') and os.path.isfile(os.path.join(directory,name))]
+
+class Stage(object):
+    """
+    One step of the batch pipeline.  `workers` threads take (path, value)
+    items off a bounded inbox, run func(path, value) and hand the result
+    to emit(path, result).  Failures go to fail(path, error) and drop
+    out of the pipeline.
+    """
+    def __init__(self, name, func, workers, emit, fail, size):
+        self.func = func
+        self.emit = emit
+        self.fail = fail
+        self.inbox = queue.Queue(maxsize=size)
+        self.threads = [threading.Thread(target=self.run,name=name + '-' + str(i),daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, path, value):
+        self.inbox.put((path,value))
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                return
+            path, value = item
+            try:
+                result = self.func(path,value)
+            except Exception as e:
+                self.fail(path,str(e))
+                continue
+            self.emit(path,result)
+
+    #wait for everything already queued to go through this stage
+    def close(self):
+        for thread in self.threads:
+            self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def create_proxies(paths, url, headers, workers=4, probe_workers=None, api_workers=None, storage_id=None, storage_root=None):
+    """
+    Runs many paths through a pipeline of stages with bounded queues in
+    between: transcode, staging, dedup, probe, create asset and proxy,
+    upload, finalize, and linking originals when storage_id is given.
+    Each stage has its own threads, so encodes, copies, mediainfo, API
+    calls and uploads for different files overlap.  workers sets the
+    number of uploads at once.  A path may be a (proxy, original, CatDV
+    ID) tuple, to make a missing proxy from its original, link the
+    original, and record the new asset against its clip.  Yields (path, new_id,
+    error) tuples as each file finishes, error is None on success and
+    new_id is None on failure.
+    """
+    probe_workers = probe_workers or mediainfo.probe_workers
+    api_workers = api_workers or workers
+    results = queue.Queue()
+    #CatDV IDs and originals from the manifest, by proxy path
+    clips = {}
+    originals = {}
+
+    def fail(path, error):
+        logger.error('Could not create proxy for ' + path + ': ' + error)
+        staging.release(path)
+        results.put((path,None,error))
+
+    def render(path, source):
+        ensure_proxy(path,source)
+
+    #copies run ahead of the rest of the pipeline, as far as its queues and the staging cap allow, and stay pinned until finalized
+    def prefetch(path, value):
+        if os.path.isfile(path):
+            staging.stage(path,pin=True,wait=True)
+
+    def check(path, value):
+        if not os.path.isfile(path):
+            raise ProxyException('File ' + path + ' does not exist')
+        if upload.get_session(path) is not None:
+            return None
+        return find_uploaded(path,url,headers,clips.get(path))
+
+    #content we already uploaded skips the rest of the pipeline
+    def route(path, existing):
+        if existing is not None:
+            staging.release(path)
+            results.put((path,existing,None))
+        else:
+            probing.put(path,None)
+
+    def probe(path, value):
+        if not os.path.isfile(path):
+            raise ProxyException('File ' + path + ' does not exist')
+        #an upload we can resume already has its asset and proxy
+        if upload.get_session(path) is not None:
+            return None
+        return probe_proxy(path)
+
+    def create(path, media_info):
+        return prepare_upload(path,url,headers,media_info,clips.get(path))
+
+    def send(path, started):
+        new_id, proxy_id, session_url, offset = started
+        send_proxy(path,url,headers,new_id,proxy_id,session_url,offset)
+        return new_id, proxy_id
+
+    def finish(path, uploaded):
+        new_id, proxy_id = uploaded
+        finish_proxy(path,url,headers,new_id,proxy_id)
+        staging.release(path)
+        return new_id
+
+    #the original is hashed once its proxy is in, and like a single upload a failed link keeps the asset
+    def link(path, new_id):
+        original = originals.get(path)
+        if original is None:
+            return new_id
+        try:
+            if not os.path.isfile(original):
+                raise ProxyException('Original ' + original + ' does not exist')
+            try:
+                md5 = checksum.get_checksum(original)
+            except (OSError, checksum.ChecksumException) as e:
+                logger.debug(str(e))
+                logger.error("Could not generate checksum for " + original)
+                md5 = None
+            link_isg(original,url,headers,new_id,storage_id,storage_root,md5)
+        except (OSError, ProxyException) as e:
+            logger.error(str(e))
+        return new_id
+
+    #built back to front so each stage knows where to send its results
+    size = workers * 2
+    linking = Stage('link',link,hash_workers,lambda path, new_id: results.put((path,new_id,None)),fail,size)
+    finalizing = Stage('finalize',finish,api_workers,linking.put,fail,size)
+    uploading = Stage('upload',send,workers,finalizing.put,fail,size)
+    creating = Stage('create',create,api_workers,uploading.put,fail,size)
+    probing = Stage('probe',probe,probe_workers,creating.put,fail,size)
+    checking = Stage('dedup',check,api_workers,route,fail,size)
+    prefetching = Stage('staging',prefetch,staging.workers,checking.put,fail,size)
+    rendering = Stage('transcode',render,transcode.workers,prefetching.put,fail,size)
+
+    def feed():
+        #the inboxes are bounded, so huge manifests are only read as fast as the pipeline drains
+        try:
+            for path in paths:
+                source = None
+                if isinstance(path,tuple):
+                    path, source, catdv_id = (path + (None,None))[:3]
+                    if catdv_id is not None:
+                        clips[path] = catdv_id
+                    if source is not None and storage_id is not None:
+                        originals[path] = source
+                rendering.put(path,source)
+        finally:
+            for stage in (rendering,prefetching,checking,probing,creating,uploading,finalizing,linking):
+                stage.close()
+            results.put(None)
+
+    threading.Thread(target=feed,name='feed',daemon=True).start()
+    while True:
+        result = results.get()
+        if result is None:
+            return
+        yield result
@@ -0,0 +1,136 @@
+import logging
+import time
+
+import store
+
+logger = logging.getLogger()
+
+#requests per second for every iconik call together and for each kind of call, overridden by the [ratelimit] section of config.ini
+enabled = True
+rates = {
+    'all':40.0,
+    'asset':10.0,
+    'proxy':20.0,
+    'metadata':25.0,
+    'delete':10.0,
+    'default':20.0,
+}
+#seconds worth of requests a bucket can save up for a burst
+burst = 2.0
+#a 429 cuts the rate to this fraction of what we were running at, which then climbs back over recovery seconds
+decrease = 0.75
+min_factor = 0.1
+recovery = 60.0
+
+#limiter state lives in sqlite so every process and thread shares the same buckets, it's fine to lose it in a crash
+schema = '''
+PRAGMA synchronous=OFF;
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL,
+    factor REAL NOT NULL,
+    throttled REAL NOT NULL
+);
+'''
+
+def configure(config):
+    """
+    Reads the optional [ratelimit] section of config.ini
+    """
+    global enabled, burst, recovery
+    enabled = config.getboolean('ratelimit','enabled',fallback=enabled)
+    burst = config.getfloat('ratelimit','burst-seconds',fallback=burst)
+    recovery = config.getfloat('ratelimit','recovery',fallback=recovery)
+    for name in rates:
+        rates[name] = config.getfloat('ratelimit',name + '-rate',fallback=rates[name])
+
+def get_bucket(method, url):
+    """
+    Returns the budget an iconik API call counts against, or None for
+    calls that aren't iconik API calls (storage uploads)
+    """
+    if '/API/' not in url:
+        return None
+    if method == 'DELETE':
+        return 'delete'
+    if '/API/metadata/' in url:
+        return 'metadata'
+    if '/API/files/' in url:
+        return 'proxy'
+    if '/API/assets/' in url:
+        return 'asset'
+    return 'default'
+
+def get_names(bucket):
+    return [name for name in ('all',bucket) if rates.get(name,0) > 0]
+
+def load(db, name, now):
+    """
+    Returns a bucket's state refilled up to now as [tokens, paused until,
+    rate factor]
+    """
+    rate = rates[name]
+    row = db.execute('SELECT tokens, updated, paused_until, factor, throttled FROM buckets WHERE name = ?',(name,)).fetchone()
+    if row is None:
+        return [rate * burst,0.0,1.0]
+    tokens, updated, paused_until, factor, throttled = row
+    factor = min(1.0,factor + (1.0 - factor) * max(0.0,now - throttled) / recovery)
+    tokens = min(rate * burst,tokens + max(0.0,now - max(updated,paused_until)) * rate * factor)
+    return [tokens,paused_until,factor]
+
+def reserve(bucket):
+    """
+    Takes a token from the shared and per-endpoint buckets and returns 0,
+    or takes nothing and returns how many seconds to wait before trying
+    again
+    """
+    if not enabled or bucket is None:
+        return 0
+    names = get_names(bucket)
+    now = time.time()
+    with store.open_db('ratelimit',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        states = {name:load(db,name,now) for name in names}
+        wait = 0
+        for name,(tokens,paused_until,factor) in states.items():
+            wait = max(wait,paused_until - now)
+            if tokens < 1:
+                wait = max(wait,(1 - tokens) / (rates[name] * factor))
+        if wait > 0:
+            return wait
+        #factor and throttled stay as the last 429 left them, so the rate climbs back linearly from there
+        for name,(tokens,paused_until,factor) in states.items():
+            db.execute('''INSERT INTO buckets (name, tokens, updated, paused_until, factor, throttled) VALUES (?, ?, ?, ?, 1.0, 0.0)
+                ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated''',(name,tokens - 1,now,paused_until))
+    return 0
+
+def acquire(bucket):
+    """
+    Blocks until the call is allowed under every budget it counts against
+    """
+    while True:
+        wait = reserve(bucket)
+        if wait <= 0:
+            return
+        logger.debug('Rate limiting ' + bucket + ' call for ' + str(round(wait,3)) + ' seconds')
+        time.sleep(wait)
+
+def throttle(bucket, retry_after=None):
+    """
+    Called when iconik answers 429.  Pauses every process for Retry-After
+    and cuts the rate of the buckets involved so we settle just under the
+    tenant limit instead of bouncing off it.
+    """
+    if not enabled or bucket is None:
+        return
+    now = time.time()
+    with store.open_db('ratelimit',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        for name in get_names(bucket):
+            tokens, paused_until, factor = load(db,name,now)
+            factor = max(min_factor,factor * decrease)
+            paused_until = max(paused_until,now + (retry_after or 0))
+            db.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated, paused_until, factor, throttled) VALUES (?, ?, ?, ?, ?, ?)',(name,0.0,now,paused_until,factor,now))
+            logger.info('iconik rate limit hit, ' + name + ' budget now ' + str(round(rates[name] * factor,1)) + ' requests per second')
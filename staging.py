@@ -0,0 +1,231 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+import metrics
+import store
+
+logger = logging.getLogger()
+
+#settings from the [staging] section of config.ini
+enabled = False
+#defaults to state/staging, put it on local SSD
+directory = None
+max_size = 50 * 1024 * 1024 * 1024
+#big sequential reads are what a busy SMB or NFS mount does best
+read_size = 16 * 1024 * 1024
+#copies to run ahead of the uploads in batch mode
+workers = 2
+#space to leave free on the staging disk
+reserve = 1024 * 1024 * 1024
+#seconds between looks for room while prefetching is paused at the cap
+wait_poll = 1.0
+
+#pins mark copies, and copies in flight, that an upload still needs, so they are never evicted from under it
+schema = '''
+CREATE TABLE IF NOT EXISTS staged (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    local TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS staged_last_used ON staged (last_used);
+CREATE TABLE IF NOT EXISTS pins (
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    since REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pins_source ON pins (source);
+'''
+
+def configure(config):
+    """
+    Reads the optional [staging] section of config.ini
+    """
+    global enabled, directory, max_size, read_size, workers
+    enabled = config.getboolean('staging','enabled',fallback=enabled)
+    directory = config.get('staging','directory',fallback=None) or None
+    max_size = int(config.getfloat('staging','max-size-gb',fallback=max_size / 1073741824) * 1073741824)
+    read_size = max(1,config.getint('staging','read-size-mb',fallback=read_size // 1048576)) * 1048576
+    workers = max(1,config.getint('staging','workers',fallback=workers))
+
+def get_directory():
+    return directory or os.path.join(store.state_dir,'staging')
+
+#the name changes with the source's content so a re-rendered proxy is never served stale
+def get_local_name(source, stat):
+    key = hashlib.sha1((source + '\n' + str(stat.st_size) + '\n' + str(stat.st_mtime_ns)).encode('utf-8')).hexdigest()
+    return os.path.join(get_directory(),key[:24] + os.path.splitext(source)[1])
+
+def pid_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def add_pin(db, source, size):
+    db.execute('INSERT INTO pins VALUES (?, ?, ?, ?)',(source,size,os.getpid(),time.time()))
+
+#a crashed process never releases its pins
+def clear_dead_pins(db):
+    for (pid,) in db.execute('SELECT DISTINCT pid FROM pins').fetchall():
+        if not pid_alive(pid):
+            db.execute('DELETE FROM pins WHERE pid = ?',(pid,))
+
+def lookup(source, stat, pin=False):
+    with store.open_db('staging',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute('SELECT local FROM staged WHERE source = ? AND size = ? AND mtime_ns = ?',(source,stat.st_size,stat.st_mtime_ns)).fetchone()
+        if row is None or not os.path.isfile(row[0]):
+            return None
+        db.execute('UPDATE staged SET last_used = ? WHERE source = ?',(time.time(),source))
+        if pin:
+            add_pin(db,source,stat.st_size)
+    return row[0]
+
+def discard(source):
+    #an older copy of a source that has since changed is of no use to anyone
+    with store.open_db('staging',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute('SELECT local FROM staged WHERE source = ?',(source,)).fetchone()
+        if row is None:
+            return
+        try:
+            os.remove(row[0])
+        except FileNotFoundError:
+            pass
+        db.execute('DELETE FROM staged WHERE source = ?',(source,))
+
+def local(path):
+    """
+    Returns where to read path from: its staged copy if there's a current
+    one, otherwise path itself
+    """
+    if not enabled:
+        return path
+    try:
+        return lookup(os.path.realpath(path),os.stat(path)) or path
+    except OSError:
+        return path
+
+def release(path):
+    """
+    Drops one of this process's pins on path once its upload is done with
+    the staged copy, so the copy can be evicted again
+    """
+    if not enabled:
+        return
+    with store.open_db('staging',schema) as db:
+        db.execute('DELETE FROM pins WHERE rowid IN (SELECT rowid FROM pins WHERE source = ? AND pid = ? LIMIT 1)',(os.path.realpath(path),os.getpid()))
+
+def evict(needed, source):
+    """
+    Removes least recently used copies no upload has pinned until needed
+    more bytes fit under max_size, counting copies still in flight, and
+    pins source for them.  Returns False, pinning nothing, if they don't
+    fit yet.
+    """
+    with store.open_db('staging',schema) as db:
+        db.execute('BEGIN IMMEDIATE')
+        clear_dead_pins(db)
+        pinned = set([row[0] for row in db.execute('SELECT DISTINCT source FROM pins').fetchall()])
+        rows = db.execute('SELECT source, local, size FROM staged ORDER BY last_used').fetchall()
+        in_flight = db.execute('SELECT coalesce(sum(size),0) FROM (SELECT max(size) AS size FROM pins WHERE source NOT IN (SELECT source FROM staged) GROUP BY source)').fetchone()[0]
+        total = sum([row[2] for row in rows]) + in_flight
+        for staged_source, local_path, size in rows:
+            if total + needed <= max_size:
+                break
+            if staged_source in pinned:
+                continue
+            logger.debug('Evicting staged copy of ' + staged_source)
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+            db.execute('DELETE FROM staged WHERE source = ?',(staged_source,))
+            total -= size
+        if total + needed > max_size:
+            return False
+        add_pin(db,source,needed)
+    return True
+
+def copy(source, target):
+    #one reused buffer, read straight into it
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    with open(source,'rb',buffering=0) as src, open(target,'wb') as dst:
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            dst.write(view[:n])
+
+def stage(path, pin=False, wait=False):
+    """
+    Copies path into the staging directory with large sequential reads,
+    unless a current copy is already there, and returns the local copy.
+    With pin the copy stays pinned until release(path), so it can't be
+    evicted before the upload is done with it.  With wait, a copy that
+    doesn't fit beside the pinned ones waits for room instead of giving
+    up, which is how prefetching pauses at the cap.  Falls back on path
+    itself when staging is off or the copy can't be made, so callers
+    never fail because of the cache.
+    """
+    if not enabled:
+        return path
+    source = os.path.realpath(path)
+    try:
+        stat = os.stat(source)
+        existing = lookup(source,stat,pin)
+        if existing is not None:
+            return existing
+        discard(source)
+        target = get_local_name(source,stat)
+        os.makedirs(os.path.dirname(target),exist_ok=True)
+        if stat.st_size > max_size or shutil.disk_usage(os.path.dirname(target)).free < stat.st_size + reserve:
+            logger.info('Not enough staging space for ' + path + ', reading it in place')
+            return path
+        #the copy is pinned while it's made so other copies count it against the cap
+        while not evict(stat.st_size,source):
+            if not wait:
+                logger.info('Staging directory is full of copies in use, reading ' + path + ' in place')
+                return path
+            time.sleep(wait_poll)
+    except OSError as e:
+        logger.warning('Could not stage ' + path + ', reading it in place: ' + str(e))
+        return path
+    partial = target + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.partial'
+    try:
+        with metrics.span('stage',path=path,bytes=stat.st_size):
+            copy(source,partial)
+        os.utime(partial,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+        #a proxy still being written would be cached half done
+        after = os.stat(source)
+        if (after.st_size,after.st_mtime_ns) != (stat.st_size,stat.st_mtime_ns):
+            logger.info(path + ' changed while staging, reading it in place')
+            os.remove(partial)
+            release(path)
+            return path
+        os.replace(partial,target)
+        with store.open_db('staging',schema) as db:
+            db.execute('INSERT OR REPLACE INTO staged VALUES (?, ?, ?, ?, ?)',(source,stat.st_size,stat.st_mtime_ns,target,time.time()))
+    except OSError as e:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        release(path)
+        logger.warning('Could not stage ' + path + ', reading it in place: ' + str(e))
+        return path
+    if not pin:
+        release(path)
+    logger.debug('Staged ' + path + ' at ' + target)
+    return target
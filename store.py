@@ -0,0 +1,33 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+#local state databases live next to our logs
+state_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),'state')
+
+#connections are kept open per thread, opening one costs more than most queries
+connections = threading.local()
+
+def connect(name, schema):
+    cache = connections.__dict__.setdefault('cache',{})
+    db = cache.get(name)
+    if db is None:
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir,exist_ok=True)
+        db = sqlite3.connect(os.path.join(state_dir,name + '.db'),timeout=60)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(schema)
+        cache[name] = db
+    return db
+
+@contextlib.contextmanager
+def open_db(name, schema):
+    """
+    Opens (and creates if needed) the SQLite database state/<name>.db and
+    commits on success or rolls back on error.  Each thread gets its own
+    connection, and several processes can use the same database at once.
+    """
+    db = connect(name,schema)
+    with db:
+        yield db
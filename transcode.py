@@ -0,0 +1,94 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+
+import metrics
+
+logger = logging.getLogger()
+
+#settings from the [transcode] section of config.ini
+enabled = False
+ffmpeg = 'ffmpeg'
+#each encode gets `threads` cores, so `workers` encodes together fill the machine
+threads = 2
+workers = max(1,(os.cpu_count() or 1) // threads)
+timeout = 7200
+#an H.264/AAC MP4 iconik can play, at most 720 lines high, with the index at the front for streaming
+arguments = '-map 0:v:0? -map 0:a:0? -c:v libx264 -preset veryfast -crf 23 -pix_fmt yuv420p -vf "scale=-2:\'min(720,ih)\'" -c:a aac -b:a 128k -ac 2 -movflags +faststart'
+
+#bounds how many encoders run at once however many threads ask for one
+slots = None
+slots_lock = threading.Lock()
+
+class TranscodeException(Exception):
+    pass
+
+def configure(config):
+    """
+    Reads the optional [transcode] section of config.ini
+    """
+    global enabled, ffmpeg, threads, workers, timeout, arguments
+    enabled = config.getboolean('transcode','enabled',fallback=enabled)
+    ffmpeg = config.get('transcode','ffmpeg',fallback=ffmpeg) or ffmpeg
+    threads = max(1,config.getint('transcode','threads',fallback=threads))
+    workers = max(1,config.getint('transcode','workers',fallback=max(1,(os.cpu_count() or 1) // threads)))
+    timeout = config.getfloat('transcode','timeout',fallback=timeout)
+    arguments = config.get('transcode','arguments',fallback=arguments) or arguments
+
+def get_slots():
+    global slots
+    with slots_lock:
+        if slots is None:
+            slots = threading.BoundedSemaphore(workers)
+        return slots
+
+def get_command(source, target):
+    return [ffmpeg,'-hide_banner','-nostdin','-loglevel','error','-y','-i',source,'-threads',str(threads)] + shlex.split(arguments) + ['-f','mp4',target]
+
+def make_proxy(source, target):
+    """
+    Encodes the original at source into a proxy at target with ffmpeg.
+    The encode is written next to target and renamed into place when it
+    finishes, so a crash never leaves a half written proxy behind to be
+    uploaded.  Raises TranscodeException on failure.
+    """
+    if shutil.which(ffmpeg) is None:
+        raise TranscodeException('ffmpeg is not installed or not in the path, cannot make a proxy for ' + source)
+    if not os.path.isfile(source):
+        raise TranscodeException('Original ' + source + ' does not exist')
+    partial = os.path.join(os.path.dirname(os.path.abspath(target)),'.' + os.path.basename(target) + '.partial')
+    with get_slots():
+        logger.info('Making proxy ' + target + ' from ' + source)
+        try:
+            with metrics.span('transcode',path=source) as fields:
+                result = subprocess.run(get_command(source,partial),stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,timeout=timeout)
+                if result.returncode != 0:
+                    fields['outcome'] = 'error'
+                else:
+                    fields['bytes'] = os.path.getsize(partial)
+        except subprocess.TimeoutExpired:
+            remove(partial)
+            raise TranscodeException('ffmpeg took longer than ' + str(timeout) + ' seconds on ' + source)
+        except OSError as e:
+            remove(partial)
+            raise TranscodeException('Could not run ffmpeg on ' + source + ': ' + str(e))
+    if result.returncode != 0:
+        remove(partial)
+        error = result.stderr.decode('utf-8','replace').strip().splitlines()
+        raise TranscodeException('ffmpeg could not make a proxy from ' + source + ': ' + (error[-1] if error else 'exit status ' + str(result.returncode)))
+    try:
+        os.replace(partial,target)
+    except OSError as e:
+        remove(partial)
+        raise TranscodeException('Could not move proxy into place at ' + target + ': ' + str(e))
+    logger.info('Made proxy ' + target)
+    return target
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
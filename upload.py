@@ -0,0 +1,142 @@
+import logging
+import os
+import random
+import re
+import time
+import requests
+
+import bandwidth
+import iconik
+import store
+
+logger = logging.getLogger()
+
+#GCS wants every chunk except the last to be a multiple of 256KiB
+chunk_quantum = 256 * 1024
+chunk_size = 32 * chunk_quantum
+retries = 5
+backoff = 1.0
+max_backoff = 60.0
+#skip proxies whose content we already uploaded to a live asset
+dedup = True
+
+range_pattern = re.compile(r'bytes=0-(\d+)')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    asset_id TEXT NOT NULL,
+    proxy_id TEXT NOT NULL,
+    session_url TEXT NOT NULL,
+    created REAL NOT NULL
+);
+'''
+
+class UploadException(Exception):
+    pass
+
+class SessionExpired(UploadException):
+    pass
+
+def configure(config):
+    """
+    Reads the optional [upload] section of config.ini
+    """
+    global chunk_size, retries, backoff, dedup
+    chunk_mb = config.getint('upload','chunk-size-mb',fallback=None)
+    if chunk_mb:
+        chunk_size = max(chunk_quantum,(chunk_mb * 1024 * 1024) // chunk_quantum * chunk_quantum)
+    retries = config.getint('upload','retries',fallback=retries)
+    backoff = config.getfloat('upload','backoff',fallback=backoff)
+    dedup = config.getboolean('upload','dedup',fallback=dedup)
+    bandwidth.configure(config)
+
+#sessions are tied to the exact file they were started for
+def get_session(path):
+    stat = os.stat(path)
+    with store.open_db('uploads',schema) as db:
+        row = db.execute('SELECT asset_id, proxy_id, session_url FROM uploads WHERE path = ? AND size = ? AND mtime = ?',(path,stat.st_size,stat.st_mtime)).fetchone()
+    return row
+
+def save_session(path, asset_id, proxy_id, session_url):
+    stat = os.stat(path)
+    with store.open_db('uploads',schema) as db:
+        db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)',(path,stat.st_size,stat.st_mtime,asset_id,proxy_id,session_url,time.time()))
+
+def clear_session(path):
+    with store.open_db('uploads',schema) as db:
+        db.execute('DELETE FROM uploads WHERE path = ?',(path,))
+
+def sleep_backoff(attempt):
+    time.sleep(min(max_backoff,backoff * (2 ** attempt)) * random.uniform(0.5,1.0))
+
+#turn a GCS response into the next byte we need to send, or None when finished
+def next_offset(r):
+    if r.status_code in (200,201):
+        return None
+    if r.status_code == 308:
+        match = range_pattern.match(r.headers.get('Range',''))
+        return int(match.group(1)) + 1 if match else 0
+    if r.status_code in (404,410):
+        raise SessionExpired('Upload session has expired')
+    raise UploadException('Unexpected upload status ' + str(r.status_code))
+
+def put(session_url, headers, data=None):
+    return iconik.get_upload_session().put(session_url,headers=headers,data=data,timeout=iconik.timeout)
+
+def query_offset(session_url, total):
+    """
+    Asks GCS how many bytes of the session it has committed
+    """
+    r = put(session_url,{'Content-Range':'bytes */' + str(total),'Content-Length':'0'})
+    return next_offset(r)
+
+def upload_file(session_url, path, offset=0):
+    """
+    Uploads path to a GCS resumable session in fixed size chunks starting
+    at offset.  After a failed chunk we ask GCS for its committed offset
+    and carry on from there, backing off between attempts.
+    """
+    total = os.path.getsize(path)
+    attempt = 0
+    with open(path,'rb') as f:
+        while True:
+            try:
+                if offset is None:
+                    return
+                if total == 0:
+                    r = put(session_url,{'Content-Range':'bytes */0','Content-Length':'0'})
+                else:
+                    f.seek(offset)
+                    chunk = f.read(chunk_size)
+                    end = offset + len(chunk) - 1
+                    logger.debug('Uploading bytes ' + str(offset) + '-' + str(end) + ' of ' + str(total) + ' for ' + path)
+                    #a capped upload waits out holds before the request, then streams the chunk through the bandwidth limiter
+                    data = chunk
+                    if bandwidth.is_enabled():
+                        data = bandwidth.ShapedChunk(chunk)
+                        data.prepare()
+                    r = put(session_url,{'Content-Range':'bytes ' + str(offset) + '-' + str(end) + '/' + str(total),'Content-Type':'application/octet-stream','Content-Length':str(len(chunk))},data)
+                if r.status_code == 429 or r.status_code >= 500:
+                    raise UploadException('Upload chunk failed with status ' + str(r.status_code))
+                offset = next_offset(r)
+                attempt = 0
+            except SessionExpired:
+                raise
+            except (requests.exceptions.RequestException, UploadException) as e:
+                if attempt >= retries:
+                    raise UploadException('Upload of ' + path + ' failed after ' + str(retries) + ' retries: ' + str(e))
+                logger.warning('Upload of ' + path + ' interrupted (' + str(e) + '), retrying')
+                sleep_backoff(attempt)
+                attempt += 1
+                try:
+                    offset = query_offset(session_url,total)
+                    if offset is not None:
+                        logger.info('Resuming upload of ' + path + ' from byte ' + str(offset))
+                except SessionExpired:
+                    raise
+                except (requests.exceptions.RequestException, UploadException) as e:
+                    #keep our last known offset, the next chunk attempt will fail or correct it
+                    logger.debug(str(e))
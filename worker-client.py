@@ -0,0 +1,54 @@
+#thin client for worker-proxy.py, only uses the standard library so it starts fast
+import argparse
+import configparser as ConfigParser
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+parser = argparse.ArgumentParser(description='Send a sync job to a running worker-proxy.py daemon')
+parser.add_argument('--listen',dest='listen',type=str,help="Address the daemon listens on, default is 127.0.0.1")
+parser.add_argument('--port',dest='port',type=int,help="Port the daemon listens on, default is 8420")
+subparsers = parser.add_subparsers(dest='job',required=True)
+
+proxy_parser = subparsers.add_parser('proxy',help="Create a new iconik proxy item from a path")
+proxy_parser.add_argument('-p','--proxy-file',dest='proxy',type=str,help="Full path to proxy file to upload",required=True)
+proxy_parser.add_argument('-o','--original-file',dest='original',type=str,help="Full path to original file to link, and to make the proxy from if it doesn't exist and the daemon has transcoding on")
+proxy_parser.add_argument('-c','--catdv-id',dest='catdvid',type=str,help="Unique ID from CatDV database, stops a re-run from creating a second asset")
+
+metadata_parser = subparsers.add_parser('metadata',help="Parse CatDV xml and update iconik metadata")
+metadata_parser.add_argument('-u','--iconik-id',dest='iconik_id',type=str,help="iconik asset id",required=True)
+metadata_parser.add_argument('-x','--xml',dest='xml',type=str, help="path to catdv v1 xml file",required=True)
+metadata_parser.add_argument('-c','--catdv-id',dest='catdvid',type=str,help="Unique ID from CatDV database",required=True)
+metadata_parser.add_argument('-v','--view',dest='view',type=str, help="iconik metadata view id")
+
+delete_parser = subparsers.add_parser('delete',help="Delete an asset from iconik")
+delete_parser.add_argument('-u','--asset-id',dest='asset_id',type=str,help="iconik asset id to delete",required=True)
+
+cli_args = parser.parse_args()
+
+config = ConfigParser.RawConfigParser(allow_no_value=True)
+config.read(os.path.dirname(os.path.realpath(__file__)) + "/config/config.ini")
+listen = cli_args.listen or config.get('daemon','listen-address',fallback=None) or '127.0.0.1'
+port = cli_args.port or config.getint('daemon','port',fallback=8420)
+
+job = {key:value for key,value in vars(cli_args).items() if key not in ('listen','port','job') and value is not None}
+request = urllib.request.Request('http://' + listen + ':' + str(port) + '/' + cli_args.job,data=json.dumps(job).encode('utf-8'),headers={'Content-Type':'application/json'})
+
+try:
+    with urllib.request.urlopen(request,timeout=7200) as r:
+        response = json.loads(r.read())
+except urllib.error.HTTPError as e:
+    try:
+        print(json.loads(e.read())['error'],file=sys.stderr)
+    except (ValueError, KeyError):
+        print(str(e),file=sys.stderr)
+    exit(1)
+except (urllib.error.URLError, OSError) as e:
+    print('Could not connect to worker-proxy.py daemon: ' + str(e),file=sys.stderr)
+    exit(1)
+
+#print our results in the form the Worker Node parses
+for line in response.get('output',[]):
+    print(line)
@@ -0,0 +1,231 @@
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#provide an interface to run from the cli without a config file
+parser = argparse.ArgumentParser(description='Resident daemon that runs iconik sync jobs for worker-client.py')
+parser.add_argument('-a','--app-id',dest='app_id',type=str,help="iconik AppID")
+parser.add_argument('-t','--token',dest='token',type=str, help="iconik App Token")
+parser.add_argument('-i','--iconik-host',dest='host',type=str,help="URL for iconik domain, default is 'https://app.iconik.io'",default='https://app.iconik.io/')
+parser.add_argument('-v','--view',dest='iconik_view',type=str, help="iconik metadata view id")
+parser.add_argument('--iconik-id-field',dest='iconik_id_field',type=str,help="Field ID in CatDV where iconik asset ID will reside")
+parser.add_argument('--iconik-url-field',dest='iconik_url_field',type=str,help="Field ID in CatDV where iconik asset link will reside")
+parser.add_argument('-l','--listen',dest='listen',type=str,help="Address to listen on, default is 127.0.0.1")
+parser.add_argument('-p','--port',dest='port',type=int,help="Port to listen on, default is 8420")
+parser.add_argument('--debug',dest='debug',default=False,action='store_true',help="Enable log debug mode")
+cli_args = parser.parse_args()
+
+#check if log file exists
+if not os.path.exists(os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs')):
+    os.makedirs(os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs'))
+
+import assetindex
+import iconik
+import jobqueue
+import mediainfo
+import metadata
+import metrics
+import proxy
+import staging
+import transcode
+import upload
+
+#check if mediainfo is installed
+if shutil.which('mediainfo') is None:
+    print("You need to have mediainfo installed and available in your path for this script to work, exiting")
+    exit(1)
+
+#set up our log
+logger = logging.getLogger()
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+handler = logging.handlers.RotatingFileHandler(os.path.dirname(os.path.realpath(__file__)) + "/logs/worker.log", maxBytes=104857600, backupCount=5)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+if cli_args.debug is True:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.INFO)
+
+#parse our config file once for the lifetime of the daemon
+config = iconik.load_config()
+settings = iconik.load_settings(config,cli_args)
+iconik.configure(config)
+metadata.configure(config)
+mediainfo.configure(config)
+upload.configure(config)
+staging.configure(config)
+transcode.configure(config)
+jobqueue.configure(config)
+metrics.configure(config,os.path.join(os.path.dirname(os.path.realpath(__file__)),'logs'),textfile=False)
+listen = cli_args.listen or config.get('daemon','listen-address',fallback=None) or '127.0.0.1'
+port = cli_args.port or config.getint('daemon','port',fallback=8420)
+
+try:
+    iconik.check_settings(settings,['app_id','token','url'])
+except iconik.IconikException as e:
+    logger.error(str(e))
+    exit(1)
+
+url = settings['url']
+headers = iconik.get_headers(settings)
+
+#validate our auth key once instead of once per clip
+try:
+    iconik.validate_token(url,headers)
+except iconik.IconikException as e:
+    logger.error(str(e))
+    exit(1)
+
+try:
+    metadata_map = metadata.load_metadata_map()
+except metadata.MetadataException as e:
+    logger.error(str(e))
+    exit(1)
+
+#each job is checked and turned into a queue payload up front, so a retry doesn't depend on files the Worker Node cleans up
+def prepare_proxy(job):
+    iconik.check_settings(settings,['iconik_id_field','iconik_url_field'])
+    original = job.get('original') if settings['use_isg'] else None
+    if original is not None:
+        iconik.check_settings(settings,['isg_storage_id','isg_root'])
+    return job.get('catdvid') or os.path.realpath(job['proxy']), {'proxy':job['proxy'],'original':original,'catdvid':job.get('catdvid'),'source':job.get('original')}
+
+def prepare_metadata(job):
+    view_id = job.get('view') or settings['view_id']
+    if not view_id:
+        raise iconik.IconikException('iconik view ID not set')
+    iconik_metadata = metadata.get_catdv_metadata(job['xml'],metadata_map)
+    iconik_post_data = metadata.build_metadata_payload(iconik_metadata,settings['catdv_id_field'],job['catdvid'])
+    return job['catdvid'], {'iconik_id':job['iconik_id'],'catdvid':job['catdvid'],'view':view_id,'payload':iconik_post_data}
+
+def prepare_delete(job):
+    return job['asset_id'], {'asset_id':job['asset_id']}
+
+#queue handlers take the prepared payload and return the lines to print for the Worker Node
+def run_proxy(payload):
+    new_id = proxy.create_proxy(payload['proxy'],url,headers,payload['original'],settings['isg_storage_id'],settings['isg_root'],payload.get('catdvid'),payload.get('source'))
+    return proxy.worker_output(new_id,settings['iconik_id_field'],settings['iconik_url_field'])
+
+#a finished proxy job is only replayed while its asset and proxy file are unchanged
+def check_proxy(job):
+    new_id = job['result'][0].partition('=')[2] if job['result'] else ''
+    if not new_id:
+        return True
+    return proxy.is_current(job['payload']['proxy'],url,headers,new_id)
+
+def run_metadata(payload):
+    metadata.update_metadata(url,headers,payload['iconik_id'],payload['view'],payload['payload'])
+    if payload.get('catdvid'):
+        assetindex.link(payload['iconik_id'],payload['catdvid'])
+    return []
+
+def run_delete(payload):
+    with metrics.span('delete',asset_id=payload['asset_id']) as fields:
+        r = iconik.delete_asset(url,headers,payload['asset_id'])
+        if r.status_code >= 400:
+            fields['outcome'] = 'error'
+    if r.status_code >= 400:
+        raise iconik.IconikException('Could not delete asset ' + payload['asset_id'] + ', iconik returned status ' + str(r.status_code))
+    #the clip's finished proxy job would otherwise keep handing out the deleted asset
+    entry = assetindex.get_entry(payload['asset_id'])
+    if entry is not None:
+        jobqueue.retire('proxy',[entry['catdv_id'],entry['path']])
+    assetindex.forget(payload['asset_id'])
+    return []
+
+jobs = {
+    '/proxy':('proxy',prepare_proxy),
+    '/metadata':('metadata',prepare_metadata),
+    '/delete':('delete',prepare_delete),
+}
+
+handlers = {
+    'proxy':run_proxy,
+    'metadata':run_metadata,
+    'delete':run_delete,
+}
+
+checks = {
+    'proxy':check_proxy,
+}
+
+class WorkerHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        response = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200,{'status':'ok'})
+        elif self.path == '/metrics':
+            response = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type','text/plain; version=0.0.4')
+            self.send_header('Content-Length',str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+        else:
+            self.send_json(404,{'error':'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path not in jobs:
+            self.send_json(404,{'error':'Unknown job ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length',0))
+            job = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400,{'error':'Could not parse job'})
+            return
+        logger.info('Running job ' + self.path + ' ' + json.dumps(job))
+        kind, prepare = jobs[self.path]
+        try:
+            key, payload = prepare(job)
+            output = jobqueue.submit(kind,key,payload,handlers,checks)
+        except KeyError as e:
+            logger.error('Job ' + self.path + ' is missing ' + str(e))
+            self.send_json(400,{'error':'Job is missing ' + str(e)})
+            return
+        except jobqueue.JobBusy as e:
+            logger.error(str(e))
+            self.send_json(409,{'error':str(e)})
+            return
+        except (jobqueue.JobException, iconik.IconikException, metadata.MetadataException) as e:
+            logger.error(str(e))
+            self.send_json(500,{'error':str(e)})
+            return
+        except Exception as e:
+            logger.exception('Unexpected error running job ' + self.path)
+            self.send_json(500,{'error':str(e)})
+            return
+        self.send_json(200,{'output':output})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+#pick up jobs a previous run of the daemon didn't finish, then keep retrying failed ones in the background
+recovered = jobqueue.recover()
+if recovered:
+    logger.info('Requeued ' + str(recovered) + ' jobs interrupted by a previous crash')
+stop = threading.Event()
+queue_thread = threading.Thread(target=jobqueue.work,args=(handlers,),kwargs={'stop':stop},name='queue',daemon=True)
+queue_thread.start()
+
+server = ThreadingHTTPServer((listen,port),WorkerHandler)
+server.daemon_threads = True
+logger.info('Listening for jobs on ' + listen + ':' + str(port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    logger.info('Shutting down')
+    stop.set()
+    server.server_close()